@@ -149,6 +149,16 @@ host
 
 : initialized? t@ f0000 and  10000 <> ;
 
+\ Names created in RAM are listed by the map. Each entry holds the previous
+\ entry, the address and the name (counted string).
+
+variable last-data
+
+: record-data ( "name" -- )
+    here last-data @ , data-here , last-data !
+    >in @ bl word count dup c, 0 ?do dup c@ c, char+ loop drop >in !
+    align ;
+
 meta
 
 : section ( low high "name" -- )
@@ -941,7 +951,8 @@ meta
 
 \ RAM
 
-: create ( "name" -- ) create data-here , immediate does> (t-constant) ;
+: create ( "name" -- )
+    record-data create data-here , immediate does> (t-constant) ;
 
 : , data-here t! data-here 1+ data-org ;
 
@@ -2560,6 +2571,23 @@ meta
     begin dup while dup t-name type space t-next repeat
     cr drop ;
 
+\ RAM areas are only listed by maps after map-ram-areas, as readers of
+\ maps may expect words only.
+
+variable ram-areas-mapped
+
+: map-ram-areas ( -- ) ram-areas-mapped on ;
+
+: map-data ( -- )
+    last-data @
+    begin
+	dup while
+	dup cell+ @ .addr .tab ." ram" .tab dup 2 cells + count type .tab
+	@ cr
+    repeat
+    drop
+;
+
 : map ( -- )
     first-addr
     begin
@@ -2568,6 +2596,7 @@ meta
 	t-next cr
     repeat
     drop
+    ram-areas-mapped @ if map-data then
 ;
 
 : map>file ( caddr a -- ) create-output-file map close-output-file ;
@@ -1,15 +1,229 @@
-fwanted = 2000
-duty = 0.5
-tosc = 1.0/26000000
-m = 1.0
-for i in range (0,3):
-	for pr2 in range (1,256):
-		prescaler = 1 << (2*i)
-		cycle = (pr2+1)*4*tosc*prescaler
-		B = 1 / cycle
-		d = abs (B - fwanted) / fwanted
-		if d < m:
-			ccpr = duty*cycle/(tosc*prescaler)
-			m = d
-			print "presc=%d, pr2=%d, err=%.3f%%, freq=%.3fHz, ccpr=%d (%d,%d)" \
-				% (prescaler, pr2, d*100, B, ccpr, ccpr/4, ccpr%4)
+#! /usr/bin/env python
+
+"""
+PWM settings solver
+
+Finds the TMR2 prescaler, PR2 and 10 bits duty cycle (CCPR1L and the DC1B
+bits of CCP1CON) giving the PWM frequency closest to a target, for a list
+of (oscillator, frequency, duty cycle) targets at once, and prints them as
+a table or as Forth constants ready to be included.
+
+    import pwm
+    for s in pwm.solve([(26e6, 2000, 0.5), (20e6, 38000, 0.25)]):
+        print s.prescaler, s.pr2, s.ccpr1l, s.dc1b, s.error
+
+Every candidate (3 prescalers times 256 PR2 values) is evaluated for every
+target in a single NumPy computation when NumPy is available, and one
+target after the other otherwise.
+
+The Forth constants are the values of PR2, T2CON (timer on) and CCPR1L,
+and of CCP1CON in PWM mode with the DC1B bits, to be stored in that order:
+
+    pwm-2khz-pr2 pr2 ! pwm-2khz-t2con t2con !
+    pwm-2khz-ccpr1l ccpr1l ! pwm-2khz-ccp1con ccp1con !
+"""
+
+import sys, getopt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+progname = sys.argv[0]
+
+# TMR2 prescalers and their T2CKPS bits
+prescalers = [(1, 0), (4, 1), (16, 2)]
+
+# candidates, the first ones (highest resolution) winning ties
+candidates = [(prescaler, ckps, pr2)
+              for prescaler, ckps in prescalers for pr2 in range(256)]
+
+class Setting:
+    """
+    PWM settings for a target, and what they achieve
+    """
+    def __init__(self, fosc, freq, duty, prescaler, ckps, pr2):
+        self.fosc = fosc
+        self.target = freq
+        self.prescaler = prescaler
+        self.pr2 = pr2
+        # PWM period in oscillator clocks
+        period = 4 * (pr2 + 1) * prescaler
+        self.freq = fosc / float(period)
+        self.error = abs(self.freq - freq) / freq
+        # duty cycle in oscillator clocks times prescaler, on 10 bits
+        self.dc = min(int(round(duty * 4 * (pr2 + 1))), 1023)
+        self.ccpr1l = self.dc >> 2
+        self.dc1b = self.dc & 3
+        self.duty = self.dc / (4.0 * (pr2 + 1))
+        self.targetDuty = duty
+        self.t2con = 0x04 | ckps
+        self.ccp1con = 0x0c | self.dc1b << 4
+
+def bestPython(fosc, freq):
+    best, bestError = None, None
+    for prescaler, ckps, pr2 in candidates:
+        error = abs(fosc / float(4 * (pr2 + 1) * prescaler) - freq)
+        if best is None or error < bestError:
+            best, bestError = (prescaler, ckps, pr2), error
+    return best
+
+def bestNumpy(foscs, freqs):
+    periods = numpy.array([4 * (pr2 + 1) * prescaler
+                           for prescaler, ckps, pr2 in candidates],
+                          dtype=float)
+    foscs = numpy.asarray(foscs, dtype=float)[:, numpy.newaxis]
+    freqs = numpy.asarray(freqs, dtype=float)[:, numpy.newaxis]
+    # argmin returns the first of the best candidates, as bestPython does
+    best = numpy.abs(foscs / periods - freqs).argmin(axis=1)
+    return [candidates[i] for i in best]
+
+def solve(targets):
+    """
+    Returns the Setting closest to each (oscillator frequency, PWM
+    frequency, duty cycle) target, duty cycles going from 0.0 to 1.0
+    """
+    targets = [(float(fosc), float(freq), float(duty))
+               for fosc, freq, duty in targets]
+    if numpy is not None and targets:
+        best = bestNumpy([t[0] for t in targets], [t[1] for t in targets])
+    else:
+        best = [bestPython(fosc, freq) for fosc, freq, duty in targets]
+    return [Setting(fosc, freq, duty, *b)
+            for (fosc, freq, duty), b in zip(targets, best)]
+
+def parseFrequency(s):
+    """
+    Parses 2000, 2k, 2kHz, 26M, 26MHz or 26e6
+    """
+    s = s.strip()
+    if s.lower().endswith("hz"):
+        s = s[:-2]
+    scale = {'k' : 1e3, 'K' : 1e3, 'M' : 1e6}.get(s[-1:])
+    if scale:
+        return float(s[:-1]) * scale
+    return float(s)
+
+def parseDuty(s):
+    """
+    Parses 0.25 or 25%
+    """
+    s = s.strip()
+    if s.endswith("%"):
+        return float(s[:-1]) / 100
+    return float(s)
+
+def label(value):
+    if value >= 1e6 and value % 1e5 == 0:
+        return "%gmhz" % (value / 1e6)
+    if value >= 1e3 and value % 100 == 0:
+        return "%gkhz" % (value / 1e3)
+    return "%ghz" % value
+
+def name(prefix, setting, foscs, duties):
+    """
+    Name of the constants of a setting, telling the targets apart
+    """
+    parts = [prefix, label(setting.target)]
+    if len(foscs) > 1:
+        parts.append(label(setting.fosc))
+    if len(duties) > 1:
+        parts.append("%g%%" % (setting.targetDuty * 100))
+    return "-".join(parts).replace(".", "_")
+
+def table(settings):
+    lines = ["%8s %9s %6s %5s %3s %6s %4s %10s %8s %6s" % (
+        "osc(MHz)", "target", "duty", "presc", "pr2", "ccpr1l", "dc1b",
+        "freq", "error", "duty")]
+    for s in settings:
+        lines.append("%8g %9g %5.1f%% %5d %3d %6d %4d %10.3f %7.3f%% %5.1f%%"
+                     % (s.fosc / 1e6, s.target, s.targetDuty * 100,
+                        s.prescaler, s.pr2, s.ccpr1l, s.dc1b, s.freq,
+                        s.error * 100, s.duty * 100))
+    return lines
+
+def forth(settings, prefix, foscs, duties):
+    lines = ["\\ PWM settings generated by pwm.py", ""]
+    for s in settings:
+        n = name(prefix, s, foscs, duties)
+        lines += ["\\ %gHz at %gMHz, %g%% duty: %.3fHz (%.3f%% error), "
+                  "%.1f%% duty" % (s.target, s.fosc / 1e6,
+                                   s.targetDuty * 100, s.freq, s.error * 100,
+                                   s.duty * 100),
+                  "$%02x constant %s-pr2" % (s.pr2, n),
+                  "$%02x constant %s-t2con" % (s.t2con, n),
+                  "$%02x constant %s-ccpr1l" % (s.ccpr1l, n),
+                  "$%02x constant %s-ccp1con" % (s.ccp1con, n),
+                  ""]
+    return lines
+
+def usage(ret=1):
+
+    err("Usage: %s [options]\n" % progname)
+    err("Computes PWM settings for every oscillator, frequency and duty "
+        "cycle given\n")
+    err("Options:\n")
+    err("   -o, --osc=f[,f...]\n")
+    err("       Oscillator frequencies (default 26MHz)\n")
+    err("   -f, --freq=f[,f...]\n")
+    err("       PWM frequencies (default 2kHz)\n")
+    err("   -d, --duty=d[,d...]\n")
+    err("       Duty cycles, as 0.5 or 50% (default 50%)\n")
+    err("   -F, --forth\n")
+    err("       Output Forth constants (pr2, t2con, ccpr1l and ccp1con)\n")
+    err("   -p, --prefix=name\n")
+    err("       Prefix of the constants names (default pwm)\n")
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "?ho:f:d:Fp:",
+            ["help", "osc=", "freq=", "duty=", "forth", "prefix="])
+    except getopt.GetoptError:
+        usage()
+
+    foscs = [26e6]
+    freqs = [2000.0]
+    duties = [0.5]
+    constants = False
+    prefix = "pwm"
+
+    try:
+        for o, a in opts:
+            if o in ("-h", "-?", "--help"):
+                usage(0)
+            elif o in ("-o", "--osc"):
+                foscs = [parseFrequency(f) for f in a.split(",")]
+            elif o in ("-f", "--freq"):
+                freqs = [parseFrequency(f) for f in a.split(",")]
+            elif o in ("-d", "--duty"):
+                duties = [parseDuty(d) for d in a.split(",")]
+            elif o in ("-F", "--forth"):
+                constants = True
+            elif o in ("-p", "--prefix"):
+                prefix = a
+    except ValueError, e:
+        err("Invalid value: %s\n" % e)
+        usage()
+
+    if args:
+        usage()
+
+    settings = solve([(fosc, freq, duty)
+                      for fosc in foscs for freq in freqs for duty in duties])
+    if constants:
+        print "\n".join(forth(settings, prefix, foscs, duties))
+    else:
+        print "\n".join(table(settings))
+
+if __name__ == '__main__':
+    main()
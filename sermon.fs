@@ -17,7 +17,9 @@ $e30 constant origin     \ suits PIC 16F873[A] and 16F88
 \ $1e30 constant origin    \ suits PIC 16F876/7[A]
 
 \ uncomment one of these to choose a baudrate
-\ (for more options, refer to the Datasheet, chapter 10, USART, table 10-4)
+\ (for more options, refer to the Datasheet, chapter 10, USART, table 10-4,
+\ or run "pfd.py --osc=<frequency> --rates"). This is the rate sessions
+\ start at; pfd.py can then switch to a faster one with the "s" command.
 
 \ $81 constant baudrate  \ 9600 baud with 20MHz oscillator
 \ $40 constant baudrate  \ 19200 baud with 20MhZ oscillator
@@ -44,7 +46,7 @@ false set-wdte
 
 \ Version
 
-5 constant version
+14 constant version
 
 \ We let 4 bytes at origin for jumping to the main program, and 4 bytes
 \ for jumping to the firmware.
@@ -57,6 +59,14 @@ include libfetch.fs
 include libstore.fs
 include picflash.fs
 
+\ Flash words written by the "W" command are received here before being
+\ programmed, as the PIC does not listen to the serial line while it writes
+\ the flash (16 words are 4 rows of 16F87xA processors).
+
+create rowbuf $20 allot
+variable rowlen
+variable rowptr
+
 \ ----------------------------------------------------------------------
 \ LED
 \ ----------------------------------------------------------------------
@@ -68,7 +78,11 @@ include picflash.fs
 \ Serial port handling
 \ ----------------------------------------------------------------------
 
-: emit ( b -- ) begin txif bit-set? until txreg ! ;
+\ Bytes sent are summed in rsum, which ends the replies in framed mode
+
+variable rsum
+
+: emit ( b -- ) dup rsum +! begin txif bit-set? until txreg ! ;
 
 macro
 : key? ( -- f ) clrwdt rcif bit-set? ;
@@ -76,8 +90,36 @@ target
 : clear-errors ( -- ) oerr bit-set? if cren bit-clr cren bit-set then ;
 : key ( -- b ) begin key? until rcreg @ clear-errors ;
 
-: get8 ( -- b ) key hex>nibble 4 lshift key hex>nibble or ;
-:: emit8 ( b -- ) dup 4 rshift nibble>hex emit $f and nibble>hex emit ;
+\ In binary mode, values are transmitted as raw bytes instead of hex digits
+
+variable binary
+
+\ In framed mode (binary too), commands and their arguments are read from
+\ a frame received and checked beforehand
+
+variable framed
+variable frameptr
+variable spaces
+
+: arg ( -- b ) framed @ if frameptr @ @ 1 frameptr +! exit then key ;
+: get8 ( -- b ) binary @ if arg exit then key hex>nibble 4 lshift key hex>nibble or ;
+:: emit8 ( b -- )
+  binary @ if emit exit then dup 4 rshift nibble>hex emit $f and nibble>hex emit ;
+
+\ Block transfers are followed by the sum (modulo 256) of their bytes
+
+variable csum
+variable remaining
+
+: emit8+ ( b -- ) dup csum +! emit8 ;
+: get8+ ( -- b ) get8 dup csum +! ;
+
+\ Range checksums are Fletcher sums modulo 256: csum adds up the bytes,
+\ and csum2 the successive values of csum
+
+variable csum2
+
+: fletcher ( b -- ) csum +! csum @ csum2 +! ;
 
 \ ----------------------------------------------------------------------
 \ Initialization
@@ -95,8 +137,24 @@ target
     \ Serial port receive (Microchip DS30292C page 102)
     $90 rcsta !                  \ Serial-enable 8bits-rx continuous-receive
     $05 option_reg !             \ CLKOUT, prescaler(tmr0)=64
+    0 binary !                   \ Start in ascii mode
+    0 framed !
 ;
 
+\ Timer routines. At 20MhZ, with a prescaler of 64, each tick corresponds
+\ to 12.8µs. Call ticks with a "negate"d value. The minimum watchdog time is
+\ 7ms; it needs to be cleared within the loop.
+
+:: ticks ( -n -- )
+    tmr0 !                                   \ Store -n into tmr0
+    t0if bit-clr                             \ Clear overflow bit
+    begin clrwdt t0if bit-set? until         \ Wait for overflow to occur
+;
+
+: 10ms ( -- ) -$c4 ticks -$c4 ticks -$c4 ticks -$c4 ticks ;
+
+: key-within ( n -- f ) tmp2 v-for 10ms key? if true exit then v-next false ;
+
 \ ----------------------------------------------------------------------s 
 \ Monitor commands
 \ ----------------------------------------------------------------------s 
@@ -107,21 +165,162 @@ target
 : emit= [char] = emit ;
 : emit: [char] : emit ;
 
+\ Outside of framed mode, a rejected command may have been cut short and
+\ have eaten into the next one, and the host may have sent more commands
+\ meanwhile: whatever comes is discarded until the line has been quiet for
+\ 100ms, so that commands are not run from the middle of their arguments.
+
+: discard ( -- ) framed @ if exit then begin $a key-within while key drop repeat ;
+: reject ( -- ) discard nack ;
+
 : flash-addr ( -- ) get8 eeadrh ! get8 eeadr ! ;
 : mon-fread ( -- ) flash-addr ack flash-read eedath @ emit8 eedata @ emit8 ;
 
 : mon-fwrite ( -- ) flash-addr get8 eedath ! get8 eedata ! ack flash-write ;
 
+: next-flash ( -- ) 1 eeadr +! eeadr @ 0= if 1 eeadrh +! then ;
+
+: row-receive ( -- )
+  rowbuf rowptr ! rowlen @ 2* remaining v-for get8+ rowptr @ ! 1 rowptr +! v-next ;
+
+: row-program ( -- )
+  rowbuf rowptr !
+  rowlen @ remaining v-for
+    rowptr @ @ eedath ! 1 rowptr +!
+    rowptr @ @ eedata ! 1 rowptr +!
+    flash-write next-flash
+  v-next ;
+
+: mon-frow ( -- )
+  flash-addr get8 dup rowlen ! 1- $10 < if
+    0 csum ! row-receive get8 csum @ = if ack row-program exit then
+  then reject ;
+
+: mon-fblock ( -- )
+  flash-addr get8 ack 0 csum !
+  remaining v-for flash-read eedath @ emit8+ eedata @ emit8+ next-flash v-next
+  csum @ emit8 ;
+
+: sum-start ( -- ) ack 0 csum ! 0 csum2 ! ;
+: sum-end ( -- ) csum @ emit8 csum2 @ emit8 ;
+
+: fsum-words ( n -- )
+  remaining v-for flash-read eedath @ fletcher eedata @ fletcher next-flash v-next ;
+
+\ The 16 bits words count is handled as its low byte, then as many times
+\ 256 words as its high byte
+
+: mon-fsum ( -- )
+  flash-addr get8 get8 sum-start
+  dup if fsum-words else drop then
+  dup if rowlen v-for 0 fsum-words v-next else drop then
+  sum-end ;
+
+\ Fills write the same value count times (0 meaning 256), and are followed
+\ by the sum (modulo 256) of their address, count and value bytes
+
+: ffill-program ( n -- ) remaining v-for flash-write next-flash v-next ;
+
+: mon-ffill ( -- )
+  0 csum ! get8+ eeadrh ! get8+ eeadr ! get8+ get8+ eedath ! get8+ eedata !
+  get8 csum @ = if ack ffill-program exit then
+  drop reject ;
+
 : mon-eread ( -- ) get8 ack ee@ emit8 ;
 : mon-ewrite ( -- ) get8 get8 ack swap ee! ;
 
+: mon-eblock ( -- )
+  get8 eeadr ! get8 ack 0 csum !
+  remaining v-for eeadr @ ee@ emit8+ 1 eeadr +! v-next
+  csum @ emit8 ;
+
+: efill-program ( n -- )
+  remaining v-for eeprom-write wait-for-eeprom 1 eeadr +! v-next ;
+
+: mon-efill ( -- )
+  0 csum ! get8+ eeadr ! get8+ get8+ eedata !
+  get8 csum @ = if ack efill-program exit then
+  drop reject ;
+
+: mon-esum ( -- )
+  get8 eeadr ! get8 sum-start
+  remaining v-for eeadr @ ee@ fletcher 1 eeadr +! v-next
+  sum-end ;
+
 : mon-mread ( -- ) get8 ack @ emit8 ;
 : mon-mwrite ( -- ) get8 get8 ack swap ! ;
 
+\ ram@ reads a file register of banks 2 and 3 when ramirp is odd. IRP is
+\ only set while the register is read, as the data stack is reached
+\ through INDF too.
+
+variable ramirp
+
+: ram@ ( addr -- b )
+  suspend-interrupts
+  ]asm
+            fsr>w
+            w>tmp1      \ save the stack pointer
+    indf ,w movf
+            w>fsr       \ point to the register
+    ramirp 0 btfsc
+    irp     bsf
+    indf ,w movf
+    irp     bcf
+            w>tmp2
+            tmp1>w
+            w>fsr       \ back to the stack
+            tmp2>w
+    indf    movwf       \ replace the address by the register contents
+  asm[
+  restore-interrupts
+;
+
+\ File registers addresses are 9 bits wide, the high byte selecting banks
+\ 2 and 3
+
+: ram-addr ( -- addr ) get8 1 and ramirp ! get8 ;
+: next-ram ( addr -- addr' ) 1+ dup 0= if 1 ramirp +! then ;
+
+: mon-rblock ( -- )
+  ram-addr get8 ack 0 csum !
+  remaining v-for dup ram@ emit8+ next-ram v-next
+  drop csum @ emit8 ;
+
+: gather-send ( -- )
+  rowbuf rowptr ! 0 csum !
+  rowlen @ remaining v-for
+    rowptr @ @ 1 and ramirp ! 1 rowptr +!
+    rowptr @ @ ram@ emit8+ 1 rowptr +!
+  v-next
+  csum @ emit8 ;
+
+: mon-gather ( -- )
+  get8 dup rowlen ! 1- $10 < if
+    0 csum ! row-receive get8 csum @ = if ack gather-send exit then
+  then reject ;
+
 : mon-exec ( -- ) get8 get8 ack swap pclath ! pcl ! ;
 
 : mon-version ( -- ) ack version emit8 ;
 
+: mon-mode ( -- )
+  get8 ack 0 spaces ! dup 2 = framed ! dup 1 = swap 2 = or binary ! ;
+
+\ Baudrate change: the new SPBRG value is kept only if the host sends
+\ "U" at the new rate within 500ms, otherwise the old one is restored.
+\ In both cases, the prompt is sent at the rate in use.
+
+variable oldbrg
+
+: wait-sent ( -- ) begin trmt bit-set? until ;
+: wait-key ( -- f ) $32 key-within ;
+: baud-confirmed? ( -- f ) wait-key if ferr bit-clr? key [char] U = and exit then false ;
+
+: mon-baud ( -- )
+  get8 ack wait-sent spbrg @ oldbrg ! spbrg !
+  baud-confirmed? 0= if oldbrg @ spbrg ! then ;
+
 macro
 : high-offset ( -- b ) origin 8 rshift ;
 : low-offset ( -- b ) origin $ff and 4 + ;
@@ -139,32 +338,73 @@ target
   dup [char] F = if drop mon-fwrite exit then
   dup [char] e = if drop mon-eread exit then
   dup [char] E = if drop mon-ewrite exit then
+  dup [char] W = if drop mon-frow exit then
+  dup [char] r = if drop mon-fblock exit then
+  dup [char] d = if drop mon-eblock exit then
+  dup [char] c = if drop mon-fsum exit then
+  dup [char] k = if drop mon-esum exit then
+  dup [char] L = if drop mon-ffill exit then
+  dup [char] l = if drop mon-efill exit then
   dup [char] m = if drop mon-mread exit then
   dup [char] M = if drop mon-mwrite exit then
+  dup [char] a = if drop mon-rblock exit then
+  dup [char] g = if drop mon-gather exit then
   dup [char] X = if drop mon-exec exit then
   dup [char] O = if drop mon-firmware exit then
   dup [char] o = if drop mon-offset exit then
   dup [char] v = if drop mon-version exit then
-  drop nack
+  dup [char] b = if drop mon-mode exit then
+  dup [char] s = if drop mon-baud exit then
+  drop binary @ if discard then 0 binary ! 0 framed ! nack
 ;
 
+\ Frames are ":" LEN SEQ payload SUM, the payload being a command and its
+\ arguments (LEN bytes, 1 to $28) and SUM the sum modulo 256 of LEN, SEQ
+\ and the payload. A frame is answered by SEQ, the usual reply of the
+\ command and the sum modulo 256 of those bytes, or by "?" if its sum does
+\ not match or if its bytes stop coming for 50ms.
+
+bank1
+create framebuf $28 allot
+bank0
+variable seq
+variable lost
+
+: frame-key ( -- b )
+  lost @ if 0 exit then
+  5 key-within if key dup csum +! exit then
+  true lost ! 0 ;
+
+: frame-receive ( -- f )
+  0 lost ! 0 csum ! frame-key frame-key seq !
+  dup 1- $28 < 0= if drop false exit then
+  framebuf frameptr !
+  remaining v-for frame-key frameptr @ ! 1 frameptr +! v-next
+  csum @ frame-key = lost @ 0= and
+  framebuf frameptr ! ;
+
+: frame-run ( -- )
+  frame-receive 0= if nack exit then
+  0 rsum ! seq @ emit arg handle-cmd rsum @ emit ;
+
+\ Spaces are answered by "?", the fourth one in a row going back to ascii
+\ mode. Other characters, such as the end of a rejected frame, are ignored.
+
+: frame-space ( -- )
+  1 spaces +! spaces @ 4 = if 0 binary ! 0 framed ! then nack ;
+
+: frame-cmd ( -- )
+  key dup [char] : = if drop 0 spaces ! frame-run exit then
+  $20 = if frame-space exit then
+  0 spaces ! ;
+
 \ ----------------------------------------------------------------------
 \ Main program and main loop
 \ ----------------------------------------------------------------------
 
-: mainloop ( -- ) led-green low led-red high begin prompt key handle-cmd again ;
-
-\ Timer routines. At 20MhZ, with a prescaler of 64, each tick corresponds
-\ to 12.8µs. Call ticks with a "negate"d value. The minimum watchdog time is
-\ 7ms; it needs to be cleared within the loop.
-
-:: ticks ( -n -- )
-    tmr0 !                                   \ Store -n into tmr0
-    t0if bit-clr                             \ Clear overflow bit
-    begin clrwdt t0if bit-set? until         \ Wait for overflow to occur
-;
-
-: 10ms ( -- ) -$c4 ticks -$c4 ticks -$c4 ticks -$c4 ticks ;
+: mainloop ( -- )
+  led-green low led-red high
+  begin prompt framed @ if frame-cmd else key handle-cmd then again ;
 
 \ If a key is pressed within four seconds, the monitor is started
 
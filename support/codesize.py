@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+
+"""
+Code size benchmark
+
+Compiles the programs of the Makefile (PROGS) and the optimizer tests
+(tests/opt-*.fs), then reports the program memory words used by each of
+them, the size of each of their words and the number of bank selection
+instructions. Sizes are compared with a baseline (support/codesize.json),
+and any word which grew is flagged.
+
+Words are those of the .map file written by the compiler. Results without
+one, such as the golden files of tests/expected, are only compared as a
+whole and never recorded into the baseline. No baseline is shipped: the
+first run with --update records one.
+
+Run it from the top directory, as "make codesize" does.
+"""
+
+import sys, os, re, getopt, json, multiprocessing
+
+import runtests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "tools"))
+import pic14
+
+progname = sys.argv[0]
+
+defaultBaseline = os.path.join("support", "codesize.json")
+
+reProgs = re.compile(r"^PROGS=((?:.*\\\n)*.*)$", re.M)
+
+def programs(names=None):
+    """
+    Returns the programs measured, as runtests.Test objects
+    """
+    progs = reProgs.search(file("Makefile").read()).group(1)
+    found = [(os.path.splitext(p)[0], os.path.splitext(p)[0] + ".fs")
+             for p in progs.replace("\\", " ").split()]
+    opts = [f for f in os.listdir(runtests.testsDir)
+            if f.startswith("opt-") and f.endswith(".fs")]
+    opts.sort()
+    found += [(f[:-3], os.path.join(runtests.testsDir, f)) for f in opts]
+    if names:
+        found = [(name, source) for name, source in found if name in names]
+    return [runtests.Test(name, source) for name, source in found]
+
+def measure(basename):
+    """
+    Returns the size of a compiled program: used program memory words and
+    bank selection instructions, in total and, when its .map file is
+    there, for each word (a word extending up to the next one). The
+    .disasm file is read rather than the .hex one, whose records are
+    padded.
+    """
+    used = []
+    banksel = []
+    for line in file(basename + ".disasm"):
+        flds = line.split("\t")
+        if line.startswith("0x") and int(flds[0], 16) < 0x2000:
+            used.append(int(flds[0], 16))
+            if pic14.isBankSwitch(int(flds[1], 16)):
+                banksel.append(used[-1])
+    if not os.path.isfile(basename + ".map"):
+        return {'words' : len(used), 'banksel' : len(banksel)}
+    starts = [(addr, name)
+              for addr, name in pic14.readMap(basename + ".map").items()
+              if addr < 0x2000]
+    starts.sort()
+    end = used and used[-1] + 1 or 0
+    sizes = {}
+    switches = {}
+    for i in range(len(starts)):
+        start, name = starts[i]
+        stop = end
+        for addr, other in starts[i + 1:]:
+            if addr > start:
+                stop = addr
+                break
+        sizes[name] = len([a for a in used if start <= a < stop])
+        count = len([a for a in banksel if start <= a < stop])
+        if count:
+            switches[name] = count
+    return {'words' : len(used), 'banksel' : len(banksel), 'sizes' : sizes,
+            'bankselByWord' : switches}
+
+def compare(name, result, baseline):
+    """
+    Returns the lines describing the words of a program which grew or
+    appeared since the baseline, and whether any grew
+    """
+    if not baseline.has_key(name):
+        return ["    no baseline"], False
+    old = baseline[name]
+    lines = []
+    grew = False
+    if not result.has_key('sizes'):
+        for key, what in (('words', "words"), ('banksel', "bank selections")):
+            if result[key] > old[key]:
+                lines.append("    %-28s grew %d -> %d %s" % (
+                    "(whole program)", old[key], result[key], what))
+                grew = True
+        return lines, grew
+    words = result['sizes'].keys()
+    words.sort()
+    for word in words:
+        size = result['sizes'][word]
+        banksel = result['bankselByWord'].get(word, 0)
+        if not old['sizes'].has_key(word):
+            lines.append("    %-28s new, %d words" % (word, size))
+            continue
+        oldBanksel = old['bankselByWord'].get(word, 0)
+        if size > old['sizes'][word]:
+            lines.append("    %-28s grew %d -> %d words" % (
+                word, old['sizes'][word], size))
+            grew = True
+        elif banksel > oldBanksel:
+            lines.append("    %-28s %d -> %d bank selections" % (
+                word, oldBanksel, banksel))
+            grew = True
+    return lines, grew
+
+def loadBaseline(path):
+    """
+    Reads a baseline, names of words being turned back into the utf-8
+    strings found in map files
+    """
+    baseline = {}
+    for prog, result in json.load(file(path)).items():
+        for key in ('sizes', 'bankselByWord'):
+            result[key] = dict([(word.encode("utf-8"), value)
+                                for word, value in result[key].items()])
+        baseline[prog.encode("utf-8")] = result
+    return baseline
+
+def usage(ret=1):
+
+    err("Usage: %s [options] [program ...]\n" % progname)
+    err("Measures the code generated for the programs and the optimizer "
+        "tests\n")
+    err("Options:\n")
+    err("   -b, --baseline=file\n")
+    err("       Baseline sizes (default %s)\n" % defaultBaseline)
+    err("   -u, --update\n")
+    err("       Store the sizes measured into the baseline\n")
+    err("   -n, --no-compile\n")
+    err("       Measure the results already in %s\n" % runtests.resultsDir)
+    err("   -r, --results=dir\n")
+    err("       Measure the .disasm and .map files of dir, implies -n\n")
+    err("   -j, --jobs=n\n")
+    err("       Compile n programs at once (default: number of processors)\n")
+    err("   -g, --gforth=path\n")
+    err("       gforth executable (default: $GFORTH or gforth)\n")
+    err("   -S, --server\n")
+    err("       Compile through the compile server when it runs (see %s)\n" %
+        os.path.join("support", "compserver.py"))
+    err("Programs are named after their source file, without .fs\n")
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "?hb:unr:j:g:S",
+            ["help", "baseline=", "update", "no-compile", "results=", "jobs=",
+             "gforth=", "server"])
+    except getopt.GetoptError:
+        usage()
+
+    baselinePath = defaultBaseline
+    update = False
+    build = True
+    jobs = multiprocessing.cpu_count()
+    gforth = os.environ.get("GFORTH", "gforth")
+
+    for o, a in opts:
+        if o in ("-h", "-?", "--help"):
+            usage(0)
+        elif o in ("-b", "--baseline"):
+            baselinePath = a
+        elif o in ("-u", "--update"):
+            update = True
+        elif o in ("-n", "--no-compile"):
+            build = False
+        elif o in ("-r", "--results"):
+            runtests.resultsDir = a
+            build = False
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o in ("-g", "--gforth"):
+            gforth = a
+        elif o in ("-S", "--server"):
+            runtests.server = runtests.compserver.defaultSocket
+
+    if not os.path.isfile(runtests.compiler):
+        err("%s must be run from the top directory\n" % progname)
+        sys.exit(2)
+
+    progs = programs(args)
+    failed = []
+    if build:
+        if not os.path.isdir(runtests.resultsDir):
+            os.mkdir(runtests.resultsDir)
+        pool = multiprocessing.Pool(max(1, min(jobs, len(progs))))
+        try:
+            for name, error in pool.imap(runtests.compileTest,
+                                         [(gforth, p.name, p.source)
+                                          for p in progs]):
+                if error:
+                    err("%s: %s\n" % (name, error.splitlines()[-1]))
+                    failed.append(name)
+        finally:
+            pool.terminate()
+
+    baseline = {}
+    if os.path.isfile(baselinePath):
+        baseline = loadBaseline(baselinePath)
+
+    print "%-20s %6s %6s %8s %8s" % ("program", "words", "delta", "banksel",
+                                     "delta")
+    grown = []
+    for prog in progs:
+        basename = os.path.join(runtests.resultsDir, prog.name)
+        if prog.name in failed or not os.path.isfile(basename + ".disasm"):
+            print "%-20s %6s" % (prog.name, "-")
+            continue
+        result = measure(basename)
+        old = baseline.get(prog.name, {'words' : 0, 'banksel' : 0})
+        print "%-20s %6d %+6d %8d %+8d" % (
+            prog.name, result['words'], result['words'] - old['words'],
+            result['banksel'], result['banksel'] - old['banksel'])
+        lines, grew = compare(prog.name, result, baseline)
+        if lines:
+            print "\n".join(lines)
+        if grew:
+            grown.append(prog.name)
+        if update and result.has_key('sizes'):
+            baseline[prog.name] = result
+        elif update:
+            err("%s: no .map file, left out of the baseline\n" % prog.name)
+
+    if update:
+        f = file(baselinePath + ".tmp", "w")
+        json.dump(baseline, f, sort_keys=True, indent=1,
+                  separators=(",", ": "))
+        f.write("\n")
+        f.close()
+        os.rename(baselinePath + ".tmp", baselinePath)
+    elif grown:
+        print
+        print "Code grew in %s" % ", ".join(grown)
+    sys.exit((failed or grown and not update) and 1 or 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+
+"""
+Compile server
+
+Keeps gforth processes with picforth.fs already loaded, and runs the
+commands given to "gforth picforth.fs -e" on them, so that builds do not
+wait for the compiler to be loaded:
+
+    support/compserver.py --serve &
+    make PICFORTH="python support/compserver.py"
+
+Started with --serve, it listens on a Unix socket (.compserver.sock in the
+top directory) for requests holding a Forth command, such as "include
+booster.fs file-dump booster.hex write-map booster.map bye". Each command
+is run by a warm compiler, which writes the .hex, .map and .disasm files
+itself and exits: as picforth.fs keeps the target image, its variables and
+the files it included in memory, a compiler cannot be brought back to its
+initial state, so every job gets a fresh one, and another one is loaded in
+the background meanwhile. Warm compilers are discarded when picforth.fs,
+one of the files it includes or the processor definitions change.
+
+Without --serve, it is a client taking the same arguments as gforth: it
+prints the output of the command and exits with its status, or runs
+gforth itself when no server is running from the current directory.
+
+Run it from the top directory.
+"""
+
+import sys, os, getopt, json, socket, threading, subprocess, Queue
+import SocketServer, multiprocessing
+
+import sources
+
+progname = sys.argv[0]
+
+defaultSocket = ".compserver.sock"
+
+# printed by compilers once picforth.fs is loaded, and once a command
+# completed without error (the rest of a line is skipped after an error)
+readyMark = "compserver-ready"
+doneMark = "compserver-done"
+
+def compilerFiles():
+    """
+    Returns the files loaded by picforth.fs and their modification times
+    """
+    stamps = []
+    for path in sources.dependencies(sources.compiler) + \
+            sources.implicitFiles:
+        if os.path.isfile(path):
+            stamps.append((path, os.path.getmtime(path)))
+    return stamps
+
+class Compiler:
+    """
+    A gforth process which loaded picforth.fs and waits for a command on
+    its standard input
+    """
+    def __init__(self, gforth):
+        self.stamps = compilerFiles()
+        self.output = ""
+        self.ready = False
+        try:
+            self.process = subprocess.Popen(
+                [gforth, sources.compiler, "-e",
+                 "forth> .( %s) cr" % readyMark],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        except OSError, e:
+            self.process = None
+            self.output = "cannot run %s: %s" % (gforth, e)
+            return
+        while True:
+            line = self.process.stdout.readline()
+            if not line or line.strip() == readyMark:
+                break
+            self.output += line
+        self.ready = bool(line)
+
+    def fresh(self):
+        return self.stamps == compilerFiles()
+
+    def run(self, command):
+        """
+        Runs a command, the compiler exiting once it is done. Returns the
+        exit status (1 if the command failed) and the output.
+        """
+        if not self.process or not self.ready:
+            if self.process:
+                self.process.wait()
+            return 1, self.output or "the compiler did not start"
+        words = command.split()
+        if words and words[-1] == "bye":
+            command = " ".join(words[:-1])
+        output = self.process.communicate(
+            "%s forth> .( %s) cr\n" % (command, doneMark))[0]
+        lines = output.splitlines(True)
+        done = [line for line in lines if line.strip() == doneMark]
+        output = "".join([line for line in lines
+                          if line.strip() != doneMark])
+        if self.process.returncode or not done:
+            return self.process.returncode or 1, output
+        return 0, output
+
+    def kill(self):
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            self.process.wait()
+
+class Pool:
+    """
+    Warm compilers, a new one being loaded as soon as one is taken
+    """
+    def __init__(self, gforth, size):
+        self.gforth = gforth
+        self.compilers = Queue.Queue()
+        for i in range(size):
+            self.load()
+
+    def load(self):
+        thread = threading.Thread(
+            target=lambda: self.compilers.put(Compiler(self.gforth)))
+        thread.setDaemon(True)
+        thread.start()
+
+    def take(self):
+        while True:
+            compiler = self.compilers.get()
+            self.load()
+            if compiler.fresh():
+                return compiler
+            compiler.kill()
+
+    def close(self):
+        while not self.compilers.empty():
+            self.compilers.get().kill()
+
+class Handler(SocketServer.StreamRequestHandler):
+    """
+    Reads a request (a line of JSON holding the command and the directory
+    of the client), answers with a line of JSON holding the exit status
+    and the output of the compiler
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request.get('cwd') != os.getcwd():
+            reply = {'error' : "serving %s" % os.getcwd()}
+        else:
+            compiler = self.server.pool.take()
+            status, output = compiler.run(request['command'].encode("utf-8"))
+            reply = {'status' : status,
+                     'output' : output.decode("utf-8", "replace")}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def listening(path):
+    """
+    Tells whether a server listens on path
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+def serve(path, gforth, size):
+    if os.path.exists(path):
+        if listening(path):
+            err("A compile server already listens on %s\n" % path)
+            sys.exit(2)
+        os.unlink(path)
+    server = Server(path, Handler)
+    server.pool = Pool(gforth, size)
+    err("Compile server listening on %s with %d compilers\n" % (path, size))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.pool.close()
+    os.unlink(path)
+
+def run(command, path=defaultSocket):
+    """
+    Runs a Forth command on the server listening on path, returns its exit
+    status and output, or None if no server runs from the current
+    directory
+    """
+    if not os.path.exists(path):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        f = s.makefile("rw")
+        f.write(json.dumps({'cwd' : os.getcwd(), 'command' : command}) + "\n")
+        f.flush()
+        reply = f.readline()
+    except socket.error:
+        return None
+    finally:
+        s.close()
+    try:
+        reply = json.loads(reply)
+    except ValueError:
+        return None
+    if not reply.has_key('status'):
+        return None
+    return reply['status'], reply['output'].encode("utf-8")
+
+def usage(ret=1):
+
+    err("Usage: %s [options] -e command\n" % progname)
+    err("       %s --serve [options]\n" % progname)
+    err("Runs a command of the compiler on a warm one kept by the compile "
+        "server,\nor on gforth if no server is running\n")
+    err("Options:\n")
+    err("   --serve\n")
+    err("       Start the compile server\n")
+    err("   -e, --evaluate=command\n")
+    err("       Forth command, as given to \"gforth picforth.fs -e\"\n")
+    err("   -S, --socket=path\n")
+    err("       Socket of the server (default %s)\n" % defaultSocket)
+    err("   -j, --jobs=n\n")
+    err("       Compilers kept loaded (default: number of processors)\n")
+    err("   -g, --gforth=path\n")
+    err("       gforth executable (default: $GFORTH or gforth)\n")
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    # accept "compserver.py picforth.fs -e command" too, as gforth does
+    argv = sys.argv[1:]
+    if argv[:1] == [sources.compiler]:
+        argv = argv[1:]
+
+    try:
+        opts, args = getopt.getopt(
+            argv,
+            "?he:S:j:g:",
+            ["help", "serve", "evaluate=", "socket=", "jobs=", "gforth="])
+    except getopt.GetoptError:
+        usage()
+
+    server = False
+    command = None
+    path = defaultSocket
+    jobs = multiprocessing.cpu_count()
+    gforth = os.environ.get("GFORTH", "gforth")
+
+    for o, a in opts:
+        if o in ("-h", "-?", "--help"):
+            usage(0)
+        elif o == "--serve":
+            server = True
+        elif o in ("-e", "--evaluate"):
+            command = a
+        elif o in ("-S", "--socket"):
+            path = a
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o in ("-g", "--gforth"):
+            gforth = a
+
+    if args or server == (command is not None):
+        usage()
+
+    if not os.path.isfile(sources.compiler):
+        err("%s must be run from the top directory\n" % progname)
+        sys.exit(2)
+
+    if server:
+        serve(path, gforth, max(1, jobs))
+        return
+
+    result = run(command, path)
+    if result is None:
+        try:
+            os.execvp(gforth, [gforth, sources.compiler, "-e", command])
+        except OSError, e:
+            err("cannot run %s: %s\n" % (gforth, e))
+            sys.exit(2)
+    status, output = result
+    sys.stdout.write(output)
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+#! /usr/bin/env python
+
+"""
+Golden tests runner
+
+Compiles every test program (tests/*.fs, and the programs of the top
+directory whose results are kept in tests/expected) with several gforth
+processes at once, and compares the .hex and .disasm files written into
+testresults with those of tests/expected, word by word.
+
+A test which passed is not compiled again until its source, the compiler,
+one of the files they include or its expected results change: their hash
+is kept in testresults/cache.json.
+
+Run it from the top directory, as "make check" does.
+"""
+
+import sys, os, re, getopt, hashlib, json, subprocess, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "tools", "bootloading"))
+import hexfile
+
+import compserver
+from sources import compiler, implicitFiles, dependencies
+
+progname = sys.argv[0]
+
+testsDir = "tests"
+expectedDir = os.path.join("tests", "expected")
+resultsDir = "testresults"
+cacheName = "cache.json"
+
+# differing instructions shown for each word
+defaultContext = 3
+
+# socket of the compile server compiling the tests, if any (see
+# compserver.py)
+server = None
+
+reName = re.compile(r"^\s*; name: (.*)$")
+
+class Test:
+    """
+    A program compiled into name.hex, name.map and name.disasm
+    """
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+
+    def outputs(self):
+        return [os.path.join(resultsDir, self.name + ext)
+                for ext in (".hex", ".map", ".disasm")]
+
+def tests(names=None):
+    """
+    Returns the tests found in tests/*.fs, plus those of the top directory
+    with expected results, restricted to names if given
+    """
+    found = {}
+    for f in os.listdir(testsDir):
+        if f.endswith(".fs"):
+            found[f[:-3]] = os.path.join(testsDir, f)
+    for f in os.listdir(expectedDir):
+        name, ext = os.path.splitext(f)
+        if ext == ".hex" and not found.has_key(name) and \
+           os.path.isfile(name + ".fs"):
+            found[name] = name + ".fs"
+    if names:
+        for name in names:
+            if not found.has_key(name):
+                err("Unknown test %s\n" % name)
+                sys.exit(2)
+        found = dict([(name, found[name]) for name in names])
+    names = found.keys()
+    names.sort()
+    return [Test(name, found[name]) for name in names]
+
+def gforthVersion(gforth):
+    try:
+        p = subprocess.Popen([gforth, "--version"], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        return p.communicate()[0].strip()
+    except OSError:
+        return None
+
+def testKey(test, common):
+    """
+    Hashes the source of a test, the files it includes and its expected
+    results, common being the hash of the compiler
+    """
+    h = hashlib.sha1(common)
+    paths = dependencies(test.source) + \
+            [os.path.join(expectedDir, test.name + ext)
+             for ext in (".hex", ".disasm")]
+    for path in paths:
+        h.update(path + "\0")
+        if os.path.isfile(path):
+            h.update(file(path, "rb").read())
+        h.update("\0")
+    return h.hexdigest()
+
+def compilerKey(gforth):
+    h = hashlib.sha1(gforthVersion(gforth) or "")
+    for path in dependencies(compiler) + implicitFiles:
+        h.update(path + "\0")
+        if os.path.isfile(path):
+            h.update(file(path, "rb").read())
+        h.update("\0")
+    return h.hexdigest()
+
+def loadCache():
+    path = os.path.join(resultsDir, cacheName)
+    if os.path.isfile(path):
+        try:
+            return json.load(file(path))
+        except ValueError:
+            pass
+    return {}
+
+def saveCache(cache):
+    path = os.path.join(resultsDir, cacheName)
+    f = file(path + ".tmp", "w")
+    json.dump(cache, f, sort_keys=True, indent=1)
+    f.close()
+    os.rename(path + ".tmp", path)
+
+def compileTest(args):
+    """
+    Runs gforth on a test, returns (name, None) or (name, error output).
+    Runs in the worker processes.
+    """
+    gforth, name, source = args
+    hexPath, mapPath, disPath = Test(name, source).outputs()
+    for path in (hexPath, mapPath, disPath):
+        if os.path.exists(path):
+            os.unlink(path)
+    command = "include %s file-dump %s write-map %s write-dis %s bye" % (
+        source, hexPath, mapPath, disPath)
+    result = None
+    if server:
+        result = compserver.run(command, server)
+    if result is None:
+        try:
+            p = subprocess.Popen([gforth, compiler, "-e", command],
+                                 stdin=file(os.devnull),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        except OSError, e:
+            return name, "cannot run %s: %s" % (gforth, e)
+        output = p.communicate()[0]
+        result = p.returncode, output
+    status, output = result
+    if status or not os.path.isfile(disPath):
+        return name, output.strip() or "%s exited with status %d" % (
+            gforth, status)
+    return name, None
+
+def readDisasm(path):
+    """
+    Splits a .disasm file into a list of (word, instructions) in address
+    order, instructions being "mnemonic operands" strings without their
+    address. Jumps and calls are described by their symbolic comment, so
+    that code moving does not change every word after it.
+    """
+    words = [("(start)", [])]
+    for line in file(path):
+        line = line.rstrip("\n")
+        m = reName.match(line)
+        if m:
+            words.append((m.group(1), []))
+            continue
+        flds = line.split("\t")
+        if len(flds) >= 4 and flds[0].startswith("0x"):
+            if len(flds) >= 5 and flds[4].startswith("; "):
+                flds[3] = flds[4][2:]
+            words[-1][1].append(" ".join(flds[2:4]).strip())
+    if not words[0][1]:
+        del words[0]
+    return words
+
+def compareDisasm(expected, actual, context=defaultContext):
+    """
+    Returns a list of lines describing the words which differ between two
+    .disasm files
+    """
+    expWords = readDisasm(expected)
+    actWords = dict(readDisasm(actual))
+    lines = []
+    seen = {}
+    for word, exp in expWords:
+        seen[word] = True
+        if not actWords.has_key(word):
+            lines.append("%s: missing (%d instructions)" % (word, len(exp)))
+            continue
+        act = actWords[word]
+        if act == exp:
+            continue
+        if len(act) != len(exp):
+            lines.append("%s: %d instructions, expected %d" % (
+                word, len(act), len(exp)))
+        else:
+            lines.append("%s: differs" % word)
+        shown = 0
+        for i in range(max(len(exp), len(act))):
+            e = i < len(exp) and exp[i] or "-"
+            a = i < len(act) and act[i] or "-"
+            if e != a:
+                if shown == context:
+                    lines.append("    ...")
+                    break
+                lines.append("    +%-4d %-24s %s" % (i, e, a))
+                shown += 1
+    for word, act in readDisasm(actual):
+        if not seen.has_key(word):
+            lines.append("%s: unexpected (%d instructions)" % (word, len(act)))
+    return lines
+
+def compareHex(expected, actual):
+    """
+    Returns a list of lines describing the words which differ between two
+    .hex files
+    """
+    exp = hexfile.Hexfile(path=expected)
+    act = hexfile.Hexfile(path=actual)
+    differ = [addr for addr in range(hexfile.Hexfile.size)
+              if exp.isUsed(addr) != act.isUsed(addr) or exp[addr] != act[addr]]
+    if not differ:
+        return []
+    return ["hex: %d words differ, first at 0x%04x (%04x expected %04x)" % (
+        len(differ), differ[0], act[differ[0]], exp[differ[0]])]
+
+def check(test, context=defaultContext):
+    """
+    Returns the differences between the results of a test and the expected
+    ones, as a list of lines
+    """
+    hexPath, mapPath, disPath = test.outputs()
+    expHex = os.path.join(expectedDir, test.name + ".hex")
+    expDis = os.path.join(expectedDir, test.name + ".disasm")
+    lines = []
+    if not os.path.isfile(expHex) or not os.path.isfile(expDis):
+        return ["no expected results in %s" % expectedDir]
+    lines += compareHex(expHex, hexPath)
+    lines += compareDisasm(expDis, disPath, context)
+    if not lines and file(expDis).read() != file(disPath).read():
+        lines.append("disasm: same instructions, different listing")
+    return lines
+
+def usage(ret=1):
+
+    err("Usage: %s [options] [test ...]\n" % progname)
+    err("Compiles the tests and compares their results with %s\n" %
+        expectedDir)
+    err("Options:\n")
+    err("   -j, --jobs=n\n")
+    err("       Compile n tests at once (default: number of processors)\n")
+    err("   -f, --force\n")
+    err("       Compile every test, even those which passed already\n")
+    err("   -c, --context=n\n")
+    err("       Differing instructions shown per word (default %d)\n" %
+        defaultContext)
+    err("   -g, --gforth=path\n")
+    err("       gforth executable (default: $GFORTH or gforth)\n")
+    err("   -S, --server\n")
+    err("       Compile through the compile server when it runs (see %s)\n" %
+        os.path.join("support", "compserver.py"))
+    err("Tests are named after their source file, without .fs\n")
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    global server
+
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "?hj:fc:g:S",
+            ["help", "jobs=", "force", "context=", "gforth=", "server"])
+    except getopt.GetoptError:
+        usage()
+
+    jobs = multiprocessing.cpu_count()
+    force = False
+    context = defaultContext
+    gforth = os.environ.get("GFORTH", "gforth")
+
+    for o, a in opts:
+        if o in ("-h", "-?", "--help"):
+            usage(0)
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o in ("-S", "--server"):
+            server = compserver.defaultSocket
+        elif o in ("-f", "--force"):
+            force = True
+        elif o in ("-c", "--context"):
+            context = int(a)
+        elif o in ("-g", "--gforth"):
+            gforth = a
+
+    if not os.path.isfile(compiler):
+        err("%s must be run from the top directory\n" % progname)
+        sys.exit(2)
+    if not os.path.isdir(resultsDir):
+        os.mkdir(resultsDir)
+
+    cache = loadCache()
+    common = compilerKey(gforth)
+    keys = {}
+    pending = []
+    cached = 0
+    for test in tests(args):
+        keys[test.name] = testKey(test, common)
+        if not force and cache.get(test.name) == keys[test.name]:
+            print "%-24s ok (cached)" % test.name
+            cached += 1
+        else:
+            pending.append(test)
+    sys.stdout.flush()
+
+    passed = failed = errors = 0
+    pool = multiprocessing.Pool(max(1, min(jobs, len(pending) or 1)))
+    try:
+        results = pool.imap(compileTest, [(gforth, t.name, t.source)
+                                          for t in pending])
+        for test in pending:
+            name, error = results.next()
+            if error:
+                print "%-24s ERROR" % name
+                for line in error.splitlines()[-5:]:
+                    print "    " + line
+                cache.pop(name, None)
+                errors += 1
+            else:
+                lines = check(test, context)
+                if lines:
+                    print "%-24s FAIL" % name
+                    for line in lines:
+                        print "    " + line
+                    cache.pop(name, None)
+                    failed += 1
+                else:
+                    print "%-24s ok" % name
+                    cache[name] = keys[name]
+                    passed += 1
+            sys.stdout.flush()
+    finally:
+        pool.terminate()
+        saveCache(cache)
+
+    print
+    print "%d passed (%d cached), %d failed, %d errors" % (
+        passed + cached, cached, failed, errors)
+    sys.exit((failed or errors) and 1 or 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""
+Compiler sources
+
+The files read by picforth.fs when it compiles a program, shared by the
+golden tests runner and the compile server.
+"""
+
+import os, re
+
+compiler = "picforth.fs"
+
+# files read by every compilation besides those included explicitly
+implicitFiles = ["pic16f628.inc", "pic16f87x.inc", "pic16f88.inc"]
+
+reInclude = re.compile(r"^\s*(?:include|needs|require)\s+(\S+)", re.M)
+
+def dependencies(path, seen=None):
+    """
+    Returns path and the files it includes, recursively. Paths starting
+    with ./ or ../ are relative to the including file, as in gforth.
+    """
+    if seen is None:
+        seen = []
+    if path in seen or not os.path.isfile(path):
+        return seen
+    seen.append(path)
+    for name in reInclude.findall(file(path).read()):
+        if name.startswith("./") or name.startswith("../"):
+            name = os.path.normpath(os.path.join(os.path.dirname(path), name))
+        dependencies(name, seen)
+    return seen
@@ -0,0 +1,201 @@
+"""
+hexfile
+
+Intel hex files holding mid-range PIC images: a parser building a dense
+image of the device memory, and a writer. Shared by pfd.py and the tools
+which only need to read images, without the serial line of pfd.py.
+
+Released into the public domain
+"""
+
+import os, array, binascii
+
+class HexError(Exception):
+    """Malformed Intel hex file"""
+
+class Hexfile:
+    """
+    parses an Intel hex file into a dense image of the device memory:
+    program memory, configuration words and eeprom (from 0x2100), with
+    a bitmap of the words actually present in the file
+    """
+    # words covered by the image
+    size = 0x2200
+    
+    def __init__(self, **options):
+    
+        f = options['path']
+    
+        if isinstance(f, str):
+            base, ext = os.path.splitext(f)
+            if ext == '':
+                f += ".hex"
+            f = file(f)
+    
+        if not hasattr(f, 'read'):
+            raise HexError("invalid file object %s" % repr(f))
+    
+        self.image = array.array('H', [0x3fff]) * self.size
+        self.used = bytearray(self.size / 8)
+    
+        # upper part of addresses, set by extended address records
+        self.base = 0
+    
+        # stream through the file, decomposing each line into address:data
+        lineno = 0
+        for line in f:
+            lineno += 1
+            if self.parseLine(line, lineno):
+                break
+    
+        # fill in any 'blanks' - make sure that for every entry, there's
+        # actually a block of 4 words (needed for 16F87xA)
+        for i in range(len(self.used)):
+            for mask in (0x0f, 0xf0):
+                rowUsed = self.used[i] & mask
+                if rowUsed and rowUsed != mask:
+                    for bit in range(8):
+                        if mask & ~rowUsed & (1 << bit):
+                            self.image[i * 8 + bit] = 0
+                    self.used[i] |= mask
+    
+    def __getitem__(self, addr):
+        return self.image[addr]
+    
+    def __len__(self):
+        """
+        Number of words present in the file
+        """
+        count = 0
+        for b in self.used:
+            while b:
+                b &= b - 1
+                count += 1
+        return count
+    
+    def isUsed(self, addr):
+        """
+        Tells whether the word at addr is present in the file
+        """
+        return self.used[addr >> 3] & (1 << (addr & 7)) != 0
+    
+    def ranges(self):
+        """
+        Returns the list of (start, end) ranges of consecutive words present
+        in the file, end being excluded
+        """
+        ranges = []
+        start = None
+        for i in range(len(self.used)):
+            b = self.used[i]
+            if b == 0xff and start is not None or b == 0 and start is None:
+                continue
+            for bit in range(8):
+                addr = i * 8 + bit
+                if b & (1 << bit):
+                    if start is None:
+                        start = addr
+                elif start is not None:
+                    ranges.append((start, addr))
+                    start = None
+        if start is not None:
+            ranges.append((start, self.size))
+        return ranges
+    
+    def words(self):
+        """
+        Iterates over the (address, value) pairs present in the file
+        """
+        for start, end in self.ranges():
+            for addr in xrange(start, end):
+                yield addr, self.image[addr]
+    
+    def parseLine(self, line, lineno):
+        """
+        parses an individual line of Intel Hex file, returns True at the
+        end of file record
+        """
+        line = line.strip()
+        if not line:
+            return False
+        try:
+            if line[0] != ':':
+                raise ValueError
+            rec = bytearray(binascii.unhexlify(line[1:]))
+        except (ValueError, TypeError):
+            raise HexError("line %d: not an Intel hex record" % lineno)
+    
+        if len(rec) < 5 or len(rec) != rec[0] + 5:
+            raise HexError("line %d: bad record length" % lineno)
+        if sum(rec) & 0xff:
+            raise HexError("line %d: bad checksum" % lineno)
+    
+        hextype = rec[3]
+        data = rec[4:-1]
+    
+        if hextype == 0:                  # data, in little-endian words
+            addr = self.base + (rec[1] << 8 | rec[2])
+            if addr + len(data) > self.size * 2:
+                raise HexError("line %d: address 0x%x out of range" %
+                               (lineno, (addr + len(data)) / 2))
+            for b in data:
+                word = addr >> 1
+                if addr & 1:
+                    self.image[word] = self.image[word] & 0xff | b << 8
+                else:
+                    self.image[word] = self.image[word] & 0xff00 | b
+                self.used[word >> 3] |= 1 << (word & 7)
+                addr += 1
+        elif hextype == 1:                # end of file
+            return True
+        elif hextype in (2, 4) and len(data) != 2:
+            raise HexError("line %d: bad address record length" % lineno)
+        elif hextype == 2:                # extended segment address
+            self.base = (data[0] << 8 | data[1]) << 4
+        elif hextype == 4:                # extended linear address
+            self.base = (data[0] << 8 | data[1]) << 16
+        elif hextype not in (3, 5):       # start addresses are meaningless
+            raise HexError("line %d: unknown record type %d" % (lineno, hextype))
+        return False
+    
+class HexWriter:
+    """
+    Writes words given in increasing address order as Intel hex records of
+    up to 8 consecutive words, each record being written once complete
+    """
+    def __init__(self, f):
+        self.f = f
+        self.start = None
+        self.words = []
+    
+    def add(self, addr, val):
+        if self.words and (addr != self.start + len(self.words) or
+                           addr % 8 == 0):
+            self.flush()
+        if not self.words:
+            self.start = addr
+        self.words.append(val)
+    
+    def flush(self):
+        """
+        Writes the pending record, if any
+        """
+        if not self.words:
+            return
+        haddr = self.start * 2   # .hex file addresses are double, since we're writing words
+        bytes = [len(self.words) * 2, haddr / 0x100, haddr % 0x100, 0]
+        for val in self.words:
+            bytes.append(val % 0x100)   # lsb
+            bytes.append(val / 0x100)   # msb
+        bytes.append((0x100 - (sum(bytes) % 0x100)) % 0x100)
+        self.f.write(":" + "".join([("%02X" % b) for b in bytes]) + "\n")
+        self.f.flush()
+        self.words = []
+    
+    def close(self):
+        """
+        Writes the pending record and the end of file record
+        """
+        self.flush()
+        self.f.write(":00000001FF\n")
+        self.f.flush()
@@ -0,0 +1,715 @@
+#! /usr/bin/env python
+
+"""
+PicForth serial monitor emulator
+
+Emulates the serial monitor of sermon.fs on a pseudo-terminal, so that
+pfd.py can be exercised and benchmarked without a PIC. Line speed, adapter
+latency, flash write time and transmission errors can be configured.
+
+The emulated processor is a 16F87xA: flash words are programmed by rows of
+4, the write happening (and the PIC no longer listening to the serial line)
+when the last word of a row is written. Bytes received while the PIC is
+busy are lost once its 2 bytes deep receive fifo is full.
+
+The rate of the PIC comes from its SPBRG register, which the "s" command
+changes, and the oscillator: while it differs from the speed the host set
+on its end of the pseudo-terminal, bytes in both directions are garbled.
+"""
+
+import sys, os, pty, tty, termios, time, random, threading, getopt, signal
+
+# most recent monitor version emulated
+defaultVersion = 14
+
+# line speed used to pace the emulated line, 0 for an infinitely fast one
+defaultBaudrate = 57600
+
+# delay (in milliseconds) added by the serial adapter to every byte
+# sent by the PIC
+defaultLatency = 0
+
+# time (in milliseconds) taken by a flash row or eeprom byte write
+defaultWriteTime = 4
+
+# oscillator of the emulated PIC, giving the rate of each SPBRG value
+defaultOsc = 20000000
+
+# largest relative difference between the rates of the host and of the
+# PIC at which bytes still get through
+rateTolerance = 0.04
+
+# time (in seconds) the monitor waits for the confirmation of a new rate
+baudConfirmTime = 0.5
+
+# time (in seconds) after which an incomplete frame is rejected
+frameTimeout = 0.05
+
+# time (in seconds) the line must stay quiet after a rejected command
+# before the monitor (from version 14 on) listens again
+discardTime = 0.1
+
+# location of the firmware vector, as returned by the 'o' command
+defaultVector = 0xe34
+
+progname = sys.argv[0]
+
+class Monitor(threading.Thread):
+    """
+    Emulated serial monitor, served on the slave side of a pseudo-terminal
+    whose name is found in the 'port' attribute
+    """
+    def __init__(self, version=defaultVersion, baudrate=defaultBaudrate,
+                 latency=defaultLatency, writeTime=defaultWriteTime,
+                 errorRate=0, vector=defaultVector, seed=None,
+                 osc=defaultOsc):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+        self.version = version
+        self.paced = bool(baudrate)
+        self.osc = osc
+        self.latency = latency / 1000.0
+        self.writeTime = writeTime / 1000.0
+        self.errorRate = errorRate
+        self.vector = vector
+        self.random = random.Random(seed)
+
+        self.flash = [0x3fff] * 0x2000
+        self.eeprom = [0xff] * 0x100
+        self.ram = [0] * 0x200
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        # the SPBRG value closest to the configured rate
+        rate = baudrate or defaultBaudrate
+        self.setSpbrg(min(range(256), key=lambda x:
+                          abs(osc / (16.0 * (x + 1)) - rate)))
+
+        # until the host sets its speed, the pseudo-terminal matches it
+        token = getattr(termios, "B%d" % rate, None)
+        if token is not None:
+            attrs = termios.tcgetattr(self.slave)
+            attrs[4] = attrs[5] = token
+            termios.tcsetattr(self.slave, termios.TCSANOW, attrs)
+
+        self.binary = False
+        self.framed = False
+        self.spaces = 0
+        self.running = False
+        self.stats = {}
+
+        # bytes of the frame being run, and sum of the bytes sent
+        self.args = None
+        self.rsum = 0
+        self.resetStats()
+
+        # received bytes, as (arrival time, byte) pairs
+        self.rx = []
+        self.rxLock = threading.Condition()
+        self.rxFree = 0
+
+        # bytes to send, as (delivery time, data) pairs
+        self.tx = []
+        self.txLock = threading.Condition()
+        self.txFree = 0
+
+        for target in (self.receiver, self.transmitter):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+
+    def resetStats(self):
+        """
+        Zeroes the counters found in the 'stats' dictionary
+        """
+        for key in ('commands', 'rx', 'tx', 'writes', 'overruns', 'errors',
+                    'rejected', 'garbled'):
+            self.stats[key] = 0
+
+    def load(self, hexfile):
+        """
+        Fills the flash and eeprom with the contents of a hexfile.Hexfile
+        """
+        for addr, val in hexfile.words():
+            if addr < 0x2000:
+                self.flash[addr] = val & 0x3fff
+            elif 0x2100 <= addr < 0x2200:
+                self.eeprom[addr - 0x2100] = val & 0xff
+
+    def corrupt(self, c):
+        """
+        Flips a random bit of c with probability errorRate
+        """
+        if self.errorRate and self.random.random() < self.errorRate:
+            self.stats['errors'] += 1
+            return chr(ord(c) ^ 1 << self.random.randrange(8))
+        return c
+
+    # ------------------------------------------------------------------
+    # Serial line
+    # ------------------------------------------------------------------
+
+    def setSpbrg(self, x):
+        """
+        Sets the rate of the PIC (high speed generator), which paces the
+        line if it is paced
+        """
+        self.spbrg = x
+        self.rate = self.osc / (16.0 * (x + 1))
+        self.byteTime = self.paced and 10.0 / self.rate or 0
+
+    def hostRate(self):
+        """
+        Speed set by the host on the pseudo-terminal, None if unknown
+        """
+        token = termios.tcgetattr(self.slave)[4]
+        for name in dir(termios):
+            if name[:1] == "B" and name[1:].isdigit() and \
+               getattr(termios, name) == token:
+                return int(name[1:])
+        return None
+
+    def garble(self, data):
+        """
+        Turns data into garbage if the host and the PIC do not use the
+        same rate
+        """
+        host = self.hostRate()
+        if not host or abs(self.rate - host) <= host * rateTolerance:
+            return data
+        self.stats['garbled'] += len(data)
+        return "".join([chr(self.random.randrange(256)) for c in data])
+
+    def receiver(self):
+        """
+        Timestamps the bytes sent by the host as if they came through a
+        serial line of the configured speed
+        """
+        while True:
+            data = self.garble(os.read(self.master, 4096))
+            now = time.time()
+            self.rxLock.acquire()
+            for c in data:
+                self.rxFree = max(now, self.rxFree) + self.byteTime
+                self.rx.append((self.rxFree, self.corrupt(c)))
+            self.stats['rx'] += len(data)
+            self.rxLock.notify()
+            self.rxLock.release()
+
+    def transmitter(self):
+        """
+        Delivers the bytes sent by the PIC once they went through the line
+        and the serial adapter
+        """
+        while True:
+            self.txLock.acquire()
+            while not self.tx:
+                self.txLock.wait()
+            when, data = self.tx.pop(0)
+            self.txLock.release()
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            os.write(self.master, data)
+
+    def key(self, timeout=None):
+        """
+        Waits for the next byte from the host, for timeout seconds at most
+        if given (None being returned if none came)
+        """
+        deadline = timeout is not None and time.time() + timeout
+        self.rxLock.acquire()
+        while not self.rx or deadline and self.rx[0][0] > deadline:
+            if not deadline:
+                self.rxLock.wait()
+            elif time.time() < deadline:
+                self.rxLock.wait(deadline - time.time())
+            else:
+                self.rxLock.release()
+                return None
+        when, c = self.rx.pop(0)
+        self.rxLock.release()
+        delay = when - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return c
+
+    def emit(self, data):
+        """
+        Sends bytes to the host
+        """
+        self.rsum += sum([ord(c) for c in data])
+        data = self.garble("".join([self.corrupt(c) for c in data]))
+        self.txLock.acquire()
+        self.txFree = max(time.time(), self.txFree) + len(data) * self.byteTime
+        self.tx.append((self.txFree + self.latency, data))
+        self.stats['tx'] += len(data)
+        self.txLock.notify()
+        self.txLock.release()
+
+    def stall(self, duration):
+        """
+        Stops listening for duration seconds, as the PIC does while it
+        writes its flash or eeprom: the receive fifo keeps 2 bytes, the
+        following ones are lost.
+        """
+        start = time.time()
+        time.sleep(duration)
+        end = time.time()
+        self.stats['writes'] += 1
+        self.rxLock.acquire()
+        kept = []
+        received = 0
+        for when, c in self.rx:
+            if start < when <= end:
+                received += 1
+                if received > 2:
+                    self.stats['overruns'] += 1
+                    continue
+            kept.append((when, c))
+        self.rx = kept
+        self.rxLock.release()
+
+    # ------------------------------------------------------------------
+    # Monitor
+    # ------------------------------------------------------------------
+
+    def arg(self):
+        """
+        Next byte of the command, read from the frame in framed mode
+        """
+        if self.args is not None:
+            # past the end of the frame, the PIC reads whatever follows
+            return self.args and self.args.pop(0) or "\0"
+        return self.key()
+
+    def get8(self):
+        if self.binary:
+            return ord(self.arg())
+        try:
+            return int(self.key() + self.key(), 16)
+        except ValueError:
+            return 0
+
+    def get16(self):
+        return self.get8() << 8 | self.get8()
+
+    def emit8(self, b, cksm=None):
+        if cksm is not None:
+            cksm[0] += b
+        if self.binary:
+            self.emit(chr(b))
+        else:
+            self.emit("%02X" % b)
+
+    def flashWrite(self, addr, val):
+        """
+        Writes a flash word, programming the row when its last word is
+        written
+        """
+        self.flash[addr & 0x1fff] = val & 0x3fff
+        if addr & 3 == 3:
+            self.stall(self.writeTime)
+
+    def run(self):
+        while True:
+            if self.running:
+                # the firmware does not listen to the monitor protocol
+                self.key()
+                continue
+            self.emit(">")
+            if self.framed:
+                self.frameCommand()
+                continue
+            self.handle(self.key())
+
+    def handle(self, c):
+        self.stats['commands'] += 1
+        handler = self.commands.get(c)
+        if handler and self.version >= handler[0]:
+            handler[1](self)
+        else:
+            if self.binary:
+                self.discard()
+            self.binary = self.framed = False
+            self.emit("?")
+
+    def discard(self):
+        """
+        Drops whatever the host sends until the line has been quiet for
+        discardTime, as monitors from version 14 on do after rejecting a
+        command outside of framed mode
+        """
+        if self.version < 14 or self.framed:
+            return
+        while self.key(discardTime) is not None:
+            pass
+
+    def reject(self):
+        self.discard()
+        self.emit("?")
+
+    def frameKeys(self, count):
+        """
+        Receives count bytes of a frame, None if they stop coming for
+        frameTimeout
+        """
+        data = []
+        for i in range(count):
+            c = self.key(frameTimeout)
+            if c is None:
+                return None
+            data.append(ord(c))
+        return data
+
+    def receiveFrame(self):
+        """
+        Returns the sequence number and the command bytes of a frame, or
+        None if it is not valid
+        """
+        header = self.frameKeys(2)
+        if header is None or not 1 <= header[0] <= 0x28:
+            return None
+        rest = self.frameKeys(header[0] + 1)
+        if rest is None or rest[-1] != (sum(header) + sum(rest[:-1])) & 0xff:
+            return None
+        return header[1], [chr(b) for b in rest[:-1]]
+
+    def frameCommand(self):
+        c = self.key()
+        if c != ":":
+            # four spaces in a row go back to ascii mode, anything else is
+            # ignored
+            self.spaces = c == " " and self.spaces + 1 or 0
+            if self.spaces:
+                self.framed = self.binary = self.spaces < 4
+                self.emit("?")
+            return
+        self.spaces = 0
+        frame = self.receiveFrame()
+        if frame is None:
+            self.stats['rejected'] += 1
+            self.emit("?")
+            return
+        seq, self.args = frame
+        self.rsum = 0
+        self.emit(chr(seq))
+        self.handle(self.arg())
+        self.args = None
+        self.emit(chr(self.rsum & 0xff))
+
+    def reset(self):
+        """
+        Restarts the monitor, as a reset of the PIC would
+        """
+        self.running = False
+        self.binary = self.framed = False
+        self.rxLock.acquire()
+        self.rx = []
+        self.rxLock.release()
+
+    def mon_fread(self):
+        addr = self.get16()
+        self.emit("!")
+        val = self.flash[addr & 0x1fff]
+        self.emit8(val >> 8)
+        self.emit8(val & 0xff)
+
+    def mon_fwrite(self):
+        addr = self.get16()
+        val = self.get16()
+        self.emit("!")
+        self.flashWrite(addr, val)
+
+    def mon_frow(self):
+        addr = self.get16()
+        count = self.get8()
+        if not 1 <= count <= 16:
+            self.reject()
+            return
+        data = [self.get8() for i in range(count * 2)]
+        if self.get8() != sum(data) % 0x100:
+            self.reject()
+            return
+        self.emit("!")
+        for i in range(count):
+            self.flashWrite(addr + i, data[2 * i] << 8 | data[2 * i + 1])
+
+    def mon_fblock(self):
+        addr = self.get16()
+        count = self.get8() or 0x100
+        self.emit("!")
+        cksm = [0]
+        for i in range(count):
+            val = self.flash[(addr + i) & 0x1fff]
+            self.emit8(val >> 8, cksm)
+            self.emit8(val & 0xff, cksm)
+        self.emit8(cksm[0] % 0x100)
+
+    def fletcher(self, data):
+        s1 = s2 = 0
+        for b in data:
+            s1 = (s1 + b) & 0xff
+            s2 = (s2 + s1) & 0xff
+        self.emit8(s1)
+        self.emit8(s2)
+
+    def mon_fsum(self):
+        addr = self.get16()
+        count = self.get16()
+        self.emit("!")
+        data = []
+        for i in range(count):
+            val = self.flash[(addr + i) & 0x1fff]
+            data.extend([val >> 8, val & 0xff])
+        self.fletcher(data)
+
+    def mon_ffill(self):
+        data = [self.get8() for i in range(5)]
+        if self.get8() != sum(data) % 0x100:
+            self.reject()
+            return
+        self.emit("!")
+        addr = data[0] << 8 | data[1]
+        for i in range(data[2] or 0x100):
+            self.flashWrite(addr + i, data[3] << 8 | data[4])
+
+    def mon_eread(self):
+        addr = self.get8()
+        self.emit("!")
+        self.emit8(self.eeprom[addr])
+
+    def mon_ewrite(self):
+        addr = self.get8()
+        val = self.get8()
+        self.emit("!")
+        self.eeprom[addr] = val
+        self.stall(self.writeTime)
+
+    def mon_eblock(self):
+        addr = self.get8()
+        count = self.get8() or 0x100
+        self.emit("!")
+        cksm = [0]
+        for i in range(count):
+            self.emit8(self.eeprom[(addr + i) & 0xff], cksm)
+        self.emit8(cksm[0] % 0x100)
+
+    def mon_esum(self):
+        addr = self.get8()
+        count = self.get8() or 0x100
+        self.emit("!")
+        self.fletcher([self.eeprom[(addr + i) & 0xff] for i in range(count)])
+
+    def mon_efill(self):
+        data = [self.get8() for i in range(3)]
+        if self.get8() != sum(data) % 0x100:
+            self.reject()
+            return
+        self.emit("!")
+        addr, count, val = data
+        for i in range(count or 0x100):
+            self.eeprom[(addr + i) & 0xff] = val
+            self.stall(self.writeTime)
+
+    def mon_mread(self):
+        addr = self.get8()
+        self.emit("!")
+        self.emit8(self.ram[addr])
+
+    def mon_mwrite(self):
+        addr = self.get8()
+        val = self.get8()
+        self.emit("!")
+        self.ram[addr] = val
+
+    def mon_rblock(self):
+        addr = self.get16()
+        count = self.get8() or 0x100
+        self.emit("!")
+        cksm = [0]
+        for i in range(count):
+            self.emit8(self.ram[(addr + i) & 0x1ff], cksm)
+        self.emit8(cksm[0] % 0x100)
+
+    def mon_gather(self):
+        count = self.get8()
+        if not 1 <= count <= 16:
+            self.reject()
+            return
+        data = [self.get8() for i in range(count * 2)]
+        if self.get8() != sum(data) % 0x100:
+            self.reject()
+            return
+        self.emit("!")
+        cksm = [0]
+        for i in range(count):
+            addr = (data[2 * i] & 1) << 8 | data[2 * i + 1]
+            self.emit8(self.ram[addr], cksm)
+        self.emit8(cksm[0] % 0x100)
+
+    def mon_exec(self):
+        self.get16()
+        self.emit("!")
+        self.running = True
+
+    def mon_firmware(self):
+        self.emit("!")
+        self.running = True
+
+    def mon_offset(self):
+        self.emit("!")
+        self.emit8(self.vector >> 8)
+        self.emit8(self.vector & 0xff)
+
+    def mon_version(self):
+        self.emit("!")
+        self.emit8(self.version)
+
+    def mon_mode(self):
+        mode = self.get8()
+        self.emit("!")
+        self.spaces = 0
+        self.framed = mode == 2 and self.version >= 13
+        self.binary = mode == 1 or self.framed
+
+    def mon_baud(self):
+        # the new rate is kept if an "U" comes at that rate in time
+        x = self.get8()
+        self.emit("!")
+        old = self.spbrg
+        self.setSpbrg(x)
+        if self.key(baudConfirmTime) != "U":
+            self.setSpbrg(old)
+
+    # command character: (first version knowing it, handler)
+    commands = {
+        'f' : (0, mon_fread),
+        'F' : (0, mon_fwrite),
+        'e' : (0, mon_eread),
+        'E' : (0, mon_ewrite),
+        'm' : (0, mon_mread),
+        'M' : (0, mon_mwrite),
+        'X' : (0, mon_exec),
+        'O' : (0, mon_firmware),
+        'o' : (0, mon_offset),
+        'v' : (5, mon_version),
+        'r' : (6, mon_fblock),
+        'd' : (6, mon_eblock),
+        'W' : (7, mon_frow),
+        'b' : (8, mon_mode),
+        's' : (9, mon_baud),
+        'c' : (10, mon_fsum),
+        'k' : (10, mon_esum),
+        'L' : (11, mon_ffill),
+        'l' : (11, mon_efill),
+        'a' : (12, mon_rblock),
+        'g' : (12, mon_gather),
+        }
+
+def usage(ret=1):
+
+    err("Usage: %s [options]\n" % progname)
+    err("PicForth serial monitor emulator, served on a pseudo-terminal\n")
+    err("Options:\n")
+    err("   -l, --link=path\n")
+    err("       Creates a symbolic link to the pseudo-terminal\n")
+    err("   -v, --version=n\n")
+    err("       Emulates version n of the monitor (default %d)\n" % defaultVersion)
+    err("   -s, --speed=nnnn\n")
+    err("       Paces the line at nnnn bps, 0 for no pacing (default %d)\n" %
+        defaultBaudrate)
+    err("   --latency=ms\n")
+    err("       Delays bytes sent by the PIC by ms milliseconds (default %d)\n" %
+        defaultLatency)
+    err("   --write-time=ms\n")
+    err("       Flash row and eeprom write time (default %d)\n" % defaultWriteTime)
+    err("   --error-rate=p\n")
+    err("       Corrupts transmitted bytes with probability p (default 0)\n")
+    err("   --osc=hz\n")
+    err("       Oscillator frequency, giving the rates of SPBRG values\n")
+    err("       (default %d)\n" % defaultOsc)
+    err("   -i, --image=file.hex\n")
+    err("       Initial contents of the flash and eeprom\n")
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    options = {'version' : defaultVersion, 'baudrate' : defaultBaudrate,
+               'latency' : defaultLatency, 'writeTime' : defaultWriteTime,
+               'errorRate' : 0, 'osc' : defaultOsc}
+    link = None
+    image = None
+
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "?hl:v:s:i:",
+            ["help", "link=", "version=", "speed=", "latency=",
+             "write-time=", "error-rate=", "osc=", "image="])
+    except getopt.GetoptError:
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "-?", "--help"):
+            usage(0)
+        elif o in ("-l", "--link"):
+            link = a
+        elif o in ("-v", "--version"):
+            options['version'] = int(a)
+        elif o in ("-s", "--speed"):
+            options['baudrate'] = int(a)
+        elif o == "--latency":
+            options['latency'] = float(a)
+        elif o == "--write-time":
+            options['writeTime'] = float(a)
+        elif o == "--error-rate":
+            options['errorRate'] = float(a)
+        elif o == "--osc":
+            options['osc'] = int(float(a))
+        elif o in ("-i", "--image"):
+            image = a
+
+    if args:
+        usage()
+
+    monitor = Monitor(**options)
+    if image:
+        import hexfile
+        monitor.load(hexfile.Hexfile(path=image))
+
+    if link:
+        if os.path.islink(link):
+            os.unlink(link)
+        os.symlink(monitor.port, link)
+
+    err("Serial monitor version %d listening on %s\n" % (
+        monitor.version, link or monitor.port))
+    monitor.start()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        err("%(commands)d commands, %(rx)d bytes received, %(tx)d sent, "
+            "%(writes)d writes, %(overruns)d overruns, "
+            "%(errors)d errors injected, %(rejected)d frames rejected, "
+            "%(garbled)d bytes garbled\n" % monitor.stats)
+    if link:
+        os.unlink(link)
+
+if __name__ == '__main__':
+    main()
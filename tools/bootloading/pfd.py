@@ -20,7 +20,112 @@ defaultBaudrate = 57600
 defaultImageSize = 8192
 #defaultImageSize = 4096
 
-import sys, os, termios, tty, time, getopt
+# number of write commands which may be in flight at once (1 means
+# stop-and-wait, waiting for the monitor's reply before each command).
+# Only commands carrying a checksum ('W', 'L' and 'l') are pipelined: the
+# monitor would take the missing arguments of a truncated 'F' or 'E' from
+# the next command and still acknowledge it. Outside of framed mode, they
+# are only pipelined with monitors from version 14 on, which discard the
+# commands in flight after rejecting one instead of running them from the
+# middle of their arguments. Pipelining only pays off on links with a
+# long round trip (such as USB adapters), so it has to be asked for.
+defaultWindow = 1
+
+# longest time (in milliseconds) the monitor needs to complete a flash or
+# eeprom write - it does not listen to the serial line meanwhile, so a
+# pipelined command is only sent once the reply of the previous one
+# arrived or this delay elapsed
+defaultWriteDelay = 8
+
+# where delta downloads keep the last image written to each device, and
+# where the device identifier (4 bytes) lives in the device eeprom
+defaultManifestDir = "~/.pfd/manifests"
+defaultIdAddress = 0xfc
+
+# where downloads record their progress, so that an interrupted one can be
+# resumed (see --resume)
+defaultJournalDir = "~/.pfd/journals"
+
+# number of words or bytes fetched by each block read command
+defaultBlockSize = 64
+
+# mismatching ranges are split in halves when verifying through checksums,
+# then read back once they are no longer than this number of words
+defaultBisectSize = 16
+
+# file registers read by each 'g' command (as many as the flash words of
+# a 'W' command, which shares its buffer)
+defaultGatherSize = 16
+
+# number of flash words sent by each 'W' command (4 rows of 16F87xA
+# processors, the most the monitor can buffer)
+defaultBurstSize = 16
+
+# shortest runs of a same flash word or eeprom byte sent as a single fill
+# command (monitors from version 11 on), a fill writing at most 256 of them
+defaultFillMinimum = 8
+defaultEepromFillMinimum = 2
+
+import sys, os, termios, tty, time, getopt, random, json
+import threading, glob, select, errno, fcntl, struct, hashlib, math
+
+from hexfile import Hexfile, HexWriter, HexError
+
+# oscillator frequency (in Hz) of the PIC, needed to compute SPBRG values
+# when switching to a faster line speed (None stays at the initial speed)
+defaultOsc = None
+
+# highest acceptable difference (in percent) between the rate obtained
+# with a SPBRG value and the standard rate
+defaultMaxError = 2.0
+
+# standard rates, fastest first
+standardBaudrates = [230400, 115200, 57600, 38400, 19200, 9600, 4800, 2400]
+
+# time (in seconds) to wait for each expected reply before giving up on
+# the monitor
+defaultTimeout = 2.0
+
+# time (in seconds) the line must stay quiet after a rejected command
+# before the monitor (from version 14 on) listens again
+discardTime = 0.1
+
+# number of times a frame is sent in framed mode (monitors from version 13
+# on) before giving up, and how long (in seconds) the line must stay quiet
+# after a bad reply before the frame is sent again (the monitor rejects an
+# incomplete frame after 50ms)
+defaultFrameAttempts = 8
+frameQuiet = 0.1
+
+# modem control line(s) resetting the PIC when asserted, if any, and for
+# how long (in milliseconds) they are asserted
+defaultReset = None
+defaultResetTime = 50
+resetLines = {
+    'dtr' : termios.TIOCM_DTR,
+    'rts' : termios.TIOCM_RTS,
+    'both' : termios.TIOCM_DTR | termios.TIOCM_RTS,
+    }
+
+# time (in seconds) to wait for the monitor when connecting (None waits
+# until the PIC is reset by hand). The monitor only listens for 4 seconds
+# after a reset, so connections following a reset pulse give up sooner.
+defaultConnectTimeout = None
+resetConnectTimeout = 5.0
+
+# commands which cannot be given together. --gang downloads to several
+# boards, so it goes along with --download.
+conflictingCommands = [
+    ('download', 'upload'),
+    ('download', 'watch'),
+    ('download', 'rates'),
+    ('upload', 'gang'),
+    ('upload', 'watch'),
+    ('upload', 'rates'),
+    ('gang', 'watch'),
+    ('gang', 'rates'),
+    ('watch', 'rates'),
+    ]
 
 class BadConnection(Exception):
     """Failed to talk to picforth bootloader"""
@@ -28,6 +133,9 @@ class BadConnection(Exception):
 class InvalidAddress(Exception):
     """Trying to read from invalid address on PIC"""
 
+class Timeout(Exception):
+    """The monitor did not answer in time"""
+
 progname = sys.argv[0]
 
 quiet = False
@@ -38,145 +146,629 @@ defaultOptions = {
     'cmd' : None,
     'path' : None,
     'size' : defaultImageSize,
+    'window' : defaultWindow,
+    'writedelay' : defaultWriteDelay,
+    'delta' : False,
+    'manifestdir' : defaultManifestDir,
+    'idaddr' : defaultIdAddress,
+    'binary' : True,
+    'framed' : False,
+    'osc' : defaultOsc,
+    'maxerror' : defaultMaxError,
+    'verify' : False,
+    'timeout' : defaultTimeout,
+    'reset' : defaultReset,
+    'resettime' : defaultResetTime,
+    'connecttimeout' : defaultConnectTimeout,
+    'ranges' : None,
+    'map' : None,
+    'resume' : False,
+    'journaldir' : defaultJournalDir,
+    'watch' : None,
+    'period' : 0,
+    'samples' : 0,
+    'stats' : None,
     }
 
-class Hexfile:
+# PIC objects whose statistics are reported (see --stats)
+sessions = []
+
+def spbrg(osc, baudrate):
     """
-    parses an Intel hex file
+    Finds the SPBRG value giving the closest rate to baudrate with the
+    high speed generator (BRGH set), returns (spbrg, relative error)
     """
-    def __init__(self, **options):
-    
-        f = options['path']
-    
-        if isinstance(f, str):
-            base, ext = os.path.splitext(f)
-            if ext == '':
-                f += ".hex"
-            f = file(f)
-    
-        if not hasattr(f, 'read'):
-            err("Invalid file object %s" % repr(f))
-            usage()
-    
-        self.rawrecs = {}
-    
-        for line in f.readlines():       # grab each line from the file
-            self.parseLine(line)         # decompose into address:data
-    
-        # write in the program start vector
-        #org = options['entry']
-        #vector = options['vector']
-        #orgH = org >> 8
-        #self.rawrecs[vector] = 0x3000 | orgH  # movlw HIGH(progOrg)
-        #self.rawrecs[vector+1] = 0x8a         # movwf PCLATH
-        #self.rawrecs[vector+2] = 0x2800 | org # goto progOrg
-        #log("Added app entry point 0x%x to vector at 0x%x\n" % (org, vector))
-    
-        # fill in any 'blanks' - make sure that for every entry, there's
-        # actually a block of 4 words (needed for 16F87xA)
-        for addr in self.rawrecs.keys():
-            # nuke out b0 and b1
-            addr1 = (addr >> 2) << 2
-            
-            for i in range(0, 4):
-                if not self.rawrecs.has_key(addr1+i):
-                    #print "Adding empty word for addr 0x%x" % (addr1+i)
-                    self.rawrecs[addr1+i] = 0
-    
-        # sort the keys
-        self.addresses = self.rawrecs.keys()
-        self.addresses.sort()
-        
-        # and create list of address,value pairs
-        self.data = [(addr, self.rawrecs[addr]) for addr in self.addresses]
-    
-        # and convert this to lines with ASCII addresses and data, ready for download
-        self.ascdata = [(("%04X" % addr), ("%04X" % val)) for (addr, val) in self.data]
-    
-    def __getitem__(self, item):
-        return self.data[item]
-    
-    def __len__(self):
-        return len(self.data)
-        
-    def parseLine(self, line):
+    best = None
+    for x in range(256):
+        error = abs(osc / (16.0 * (x + 1)) - baudrate) / baudrate
+        if best is None or error < best[1]:
+            best = (x, error)
+    return best
+
+def baudrates(osc, maxError=defaultMaxError):
+    """
+    Lists the (rate, SPBRG, error in percent) standard rates which can be
+    obtained within maxError percent, fastest first
+    """
+    rates = []
+    for rate in standardBaudrates:
+        x, error = spbrg(osc, rate)
+        if error * 100 <= maxError and hasattr(termios, "B%d" % rate):
+            rates.append((rate, x, error * 100))
+    return rates
+
+def fletcher(data, sums=(0, 0)):
+    """
+    Fletcher sums modulo 256 of a list of bytes, as computed by the 'c'
+    and 'k' monitor commands, continuing from sums
+    """
+    s1, s2 = sums
+    for b in data:
+        s1 = (s1 + b) & 0xff
+        s2 = (s2 + s1) & 0xff
+    return s1, s2
+
+def parseRanges(spec):
+    """
+    Parses a comma separated list of word address ranges ("start-end",
+    both included, or a single address) into (start, end, tail) tuples
+    as used by PIC.upload()
+    """
+    ranges = []
+    for item in spec.split(","):
+        bounds = item.split("-")
+        if len(bounds) > 2:
+            raise ValueError("invalid range %s" % item)
+        ranges.append((int(bounds[0], 0), int(bounds[-1], 0) + 1, False))
+    return ranges
+
+def mapRanges(path, size=defaultImageSize):
+    """
+    Address ranges holding the words listed in a PicForth .map file, as
+    (start, end, tail) tuples used by PIC.upload(): program memory up to
+    the last word, then up to the first erased block after it (the last
+    word size being unknown), and the eeprom
+    """
+    addresses = [0]
+    for line in file(path):
+        fields = line.split()
+        if fields and fields[1:2] != ["ram"]:
+            addresses.append(int(fields[0], 16))
+    last = max(addresses)
+    return [(0, last, False), (last, size, True), (0x2100, 0x2200, False)]
+
+def mapVariables(path):
+    """
+    Name->address dictionary of the RAM areas (variables, created areas)
+    listed in a PicForth .map file written after map-ram-areas
+    """
+    variables = {}
+    for line in file(path):
+        fields = line.split()
+        if len(fields) >= 3 and fields[1] == "ram":
+            variables[fields[2]] = int(fields[0], 16)
+    return variables
+
+def parseWatch(spec, variables={}):
+    """
+    Resolves a comma separated list of file registers, given as names
+    found in a map (see mapVariables()), as name+offset or as addresses,
+    into a list of (label, address) pairs
+    """
+    registers = []
+    for item in spec.split(","):
+        item = item.strip()
+        name, plus, offset = item.partition("+")
+        if variables.has_key(name):
+            addr = variables[name] + int(offset or "0", 0)
+        else:
+            try:
+                addr = int(item, 0)
+            except ValueError:
+                raise ValueError("unknown variable %s" % item)
+        if not 0 <= addr < 0x200:
+            raise ValueError("invalid file register %s" % item)
+        registers.append((item, addr))
+    return registers
+
+def erased(addr):
+    """
+    Contents of an erased word at addr
+    """
+    if addr >= 0x2100:
+        return 0xff
+    return 0x3fff
+
+class Manifest:
+    """
+    Last image written to a device, persisted between runs so that a
+    delta download only has to send the words which changed
+    """
+    def __init__(self, devid, directory=defaultManifestDir):
+        directory = os.path.expanduser(directory)
+        self.path = os.path.join(directory, "%s.json" % devid)
+        self.devid = devid
+        self.words = {}
+        self.vector = None
+        self.complete = False
+    
+        if os.path.isfile(self.path):
+            contents = json.load(file(self.path))
+            self.words = dict([(int(addr, 16), val)
+                               for addr, val in contents['words'].items()])
+            self.vector = contents['vector']
+            self.complete = contents['complete']
+    
+    def fresh(self, vector):
         """
-        parses an individual line of Intel Hex file
+        Tells whether the manifest describes a completed download made
+        through the same serial monitor
         """
-        hexlen = line[1:3]        # number of data bytes on the line
-        hexaddr = line[3:7]       # starting address of data on line
-        hextype = line[7:9]       # 00 - data, 01 - eof
-        hexdata = line[9:-2]      # data bytes (use words for the 14 bit PIC instructions)
-        #hexcrc = line[-2:]        # crc of line
+        return self.complete and self.words and self.vector == vector
     
-        linelen = self.fromHex(hexlen)    # decompose line length
-        lineaddr = self.fromHex(hexaddr)  # decompose starting address
-    
-        if hextype != '01':                 # if not eof
-            for i in range(0, linelen, 2):    # grab each data word
-                s = hexdata[i*2+2:i*2+4] + hexdata[i*2:i*2+2]
-                val = self.fromHex(s)
-                #print "%s = %s" % (s, val)
-                #self[(lineaddr + i)/2] = hexdata[i*2:i*2+4]    # populate dict. with addr:data
-                self.rawrecs[(lineaddr + i)/2] = val
-    
-    def fromHex(self, s):
-        
-        return int(s, 16)
+    def save(self, complete):
+        """
+        Writes the manifest - an incomplete manifest is marked stale so that
+        an interrupted download is never trusted
+        """
+        self.complete = complete
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        words = dict([("%04X" % addr, val) for addr, val in self.words.items()])
+        f = file(self.path + ".tmp", "w")
+        json.dump({'device' : self.devid,
+                   'vector' : self.vector,
+                   'complete' : complete,
+                   'words' : words}, f, sort_keys=True)
+        f.close()
+        os.rename(self.path + ".tmp", self.path)
+    
+def planDigest(plan):
+    """
+    Hashes the (address, value) pairs of a download plan
+    """
+    h = hashlib.sha1()
+    for addr, val in plan:
+        h.update("%04X%04X" % (addr, val))
+    return h.hexdigest()
+
+class Journal:
+    """
+    Progress of a download through a serial port, saved each time the
+    monitor acknowledges a command so that an interrupted download can be
+    resumed. Progress is counted in entries of the download plan, and only
+    applies to the plan it was recorded for.
+    """
+    def __init__(self, port, digest, directory=defaultJournalDir):
+        directory = os.path.expanduser(directory)
+        name = port.strip("/").replace("/", "_")
+        self.path = os.path.join(directory, "%s.json" % name)
+        self.port = port
+        self.digest = digest
+        # entries acknowledged, the last command having written those from
+        # self.last on
+        self.done = 0
+        self.last = 0
+    
+        if os.path.isfile(self.path):
+            try:
+                contents = json.load(file(self.path))
+            except ValueError:
+                return
+            if contents['digest'] == digest and contents['port'] == port:
+                self.done = contents['done']
+                self.last = contents['last']
+    
+    def confirm(self, start, end):
+        """
+        Records that the entries from start to end (excluded) were written
+        """
+        self.last = start
+        self.done = end
+        self.save()
+    
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = file(self.path + ".tmp", "w")
+        json.dump({'port' : self.port,
+                   'digest' : self.digest,
+                   'done' : self.done,
+                   'last' : self.last}, f, sort_keys=True)
+        f.close()
+        os.rename(self.path + ".tmp", self.path)
+    
+    def clear(self):
+        """
+        Forgets about a completed download
+        """
+        if os.path.isfile(self.path):
+            os.unlink(self.path)
+        self.done = self.last = 0
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile p (0 to 100) of a list of values
+    """
+    values = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(values))))
+    return values[rank - 1]
+
+class Stats:
+    """
+    Session statistics: bytes sent and received, connection time, retries,
+    and latency of every monitor command from the moment it is written
+    to the moment its prompt is read. Prompts are matched in order with
+    outstanding commands, as several of them may be in flight.
+    """
+    # command characters, telling commands from the spaces and baud rate
+    # confirmations written outside of them
+    commands = "fFeEWLlrdckmMagXOovbs"
+    
+    def __init__(self):
+        self.start = time.time()
+        self.connect = None
+        self.sent = 0
+        self.received = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.pending = []
+        self.latencies = {}
+    
+    def write(self, data):
+        self.sent += len(data)
+        # frames hold their command after a colon, length and sequence
+        cmd = data[:1] == ":" and data[3:4] or data[:1]
+        if cmd and cmd in self.commands:
+            self.pending.append((cmd, time.time()))
+    
+    def prompt(self, accepted=True):
+        """
+        Records the end of the oldest outstanding command, counting it as
+        a retry if the monitor rejected it
+        """
+        if not self.pending:
+            return
+        cmd, start = self.pending.pop(0)
+        if accepted:
+            self.latencies.setdefault(cmd, []).append(time.time() - start)
+        else:
+            self.retries += 1
     
-    def keys(self):
+    def abandon(self):
         """
-        Convenience wrapper - returns dict keys in order
+        Forgets about outstanding commands once the monitor has been
+        brought back to its prompt
         """
-        keys = dict.keys(self)
-        keys.sort()
-        return keys
+        self.pending = []
     
-    def hexkeys(self):
+    def report(self):
         """
-        For debugging, returns keys in order, as hex
+        Returns the statistics as a dictionary, times being in seconds and
+        latencies in milliseconds
         """
-        return "[" + ", ".join([("%x" % k) for k in self.keys()]) + "]"
+        commands = {}
+        for cmd, latencies in self.latencies.items():
+            ms = [t * 1000 for t in latencies]
+            commands[cmd] = {'count' : len(ms),
+                             'mean' : sum(ms) / len(ms),
+                             'p50' : percentile(ms, 50),
+                             'p90' : percentile(ms, 90),
+                             'p99' : percentile(ms, 99),
+                             'max' : max(ms)}
+        return {'duration' : time.time() - self.start,
+                'connect' : self.connect,
+                'sent' : self.sent,
+                'received' : self.received,
+                'retries' : self.retries,
+                'fallbacks' : self.fallbacks,
+                'commands' : commands}
     
 class Tty:
     """
-    Wraps a serial link to PIC
+    Wraps a serial link to PIC. Everything available is read at once into
+    a receive buffer, and reads wait for data with poll() rather than
+    retrying, up to a deadline.
     """
     def __init__(self, **options):
         
+        fd = os.open(options['port'], os.O_RDWR | os.O_NONBLOCK, 0777)
+        tty.setraw(fd)
+    
+        self.fd = fd
+        self.buffer = ""
+        self.timeout = float(options.get('timeout', defaultTimeout))
+        self.stats = None
+        self.setSpeed(options['speed'])
+    
+    def setSpeed(self, speed):
+        """
+        Changes the line speed once everything written has been sent
+        """
         try:
-            speedToken = getattr(termios, "B%s" % options['speed'])
+            speedToken = getattr(termios, "B%s" % speed)
         except:
-            raise Exception("Invalid baudrate %s" % repr(options['speed']))
+            raise Exception("Invalid baudrate %s" % repr(speed))
     
-        fd = os.open(options['port'], os.O_RDWR | os.O_NONBLOCK, 0777)
-        attr = termios.tcgetattr(fd)
+        attr = termios.tcgetattr(self.fd)
         attr[4] = attr[5] = speedToken
         termios.tcsetattr(
-            fd,
-            termios.TCSANOW,
+            self.fd,
+            termios.TCSADRAIN,
             attr)
-        tty.setraw(fd)
+        self.speed = int(speed)
     
-        self.fd = fd
-    
-    def read(self, n=1, blocking=False):
-        while 1:
+    def wait(self, event, timeout):
+        """
+        Waits up to timeout seconds for the line to be ready for event
+        (select.POLLIN or select.POLLOUT), returns False if it is not
+        """
+        poller = select.poll()
+        poller.register(self.fd, event)
+        while True:
             try:
-                c = os.read(self.fd, n)
-            except OSError:
-                c = ''
-            if c or not blocking:
-                return c
-    
-        return None  # satisfy pychecker
+                events = poller.poll(max(0, int(timeout * 1000)))
+                break
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+        for fd, flags in events:
+            if flags & (select.POLLERR | select.POLLNVAL):
+                raise IOError("Serial line error")
+            if flags & event:
+                return True
+            if flags & select.POLLHUP:
+                raise IOError("Serial line hung up")
+        return False
+    
+    def fill(self, timeout=0):
+        """
+        Appends everything received to the buffer, waiting up to timeout
+        seconds for something to arrive
+        """
+        if not self.wait(select.POLLIN, timeout):
+            return
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+            return
+        self.buffer += data
+        if self.stats:
+            self.stats.received += len(data)
+    
+    def read(self, n=1, blocking=False, timeout=None):
+        """
+        Returns n received characters, raising Timeout if they do not
+        arrive in time (the default timeout of the line unless given).
+        When not blocking, returns whatever up to n characters arrive
+        within timeout seconds (nothing is waited for by default).
+        """
+        if blocking:
+            deadline = time.time() + (timeout or self.timeout)
+            while len(self.buffer) < n:
+                left = deadline - time.time()
+                if left <= 0:
+                    raise Timeout("No answer from the monitor")
+                self.fill(left)
+        elif not self.buffer:
+            self.fill(timeout or 0)
+        c, self.buffer = self.buffer[:n], self.buffer[n:]
+        return c
     
     def write(self, s):
-        os.write(self.fd, s)
+        if self.stats:
+            self.stats.write(s)
+        deadline = time.time() + self.timeout
+        while s:
+            try:
+                s = s[os.write(self.fd, s):]
+                continue
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            left = deadline - time.time()
+            if left <= 0 or not self.wait(select.POLLOUT, left):
+                raise Timeout("Serial line does not accept data")
+    
+    def pulse(self, lines, duration):
+        """
+        Asserts the given modem control lines (TIOCM_* bits) for duration
+        seconds, then releases them
+        """
+        bits = struct.pack('I', lines)
+        try:
+            fcntl.ioctl(self.fd, termios.TIOCMBIS, bits)
+            time.sleep(duration)
+            fcntl.ioctl(self.fd, termios.TIOCMBIC, bits)
+        except IOError, e:
+            raise IOError("Cannot drive the modem control lines: %s" %
+                          e.strerror)
+    
+    def drain(self):
+        """
+        Waits until everything written has been transmitted
+        """
+        termios.tcdrain(self.fd)
+    
+    def flush(self):
+        """
+        Discards everything received but not read yet
+        """
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+        self.buffer = ""
     
     def __del__(self):
         os.close(self.fd)
     
+class Pipeline:
+    """
+    Transfer engine keeping up to 'window' monitor commands in flight.
+    Commands without a checksum are sent in stop-and-wait mode, once the
+    commands in flight have been acknowledged.
+
+    Each command is queued with the reply it should produce, and replies
+    are matched in order against the oldest outstanding command. On the
+    first mismatch, the monitor is brought back to its prompt, every
+    unconfirmed command is sent again and the engine falls back to
+    stop-and-wait for the rest of the session.
+
+    In framed mode, a bad reply only makes the engine wait for the monitor
+    to be quiet, then send the frame again along with every later one, so
+    that flash rows are still written in order, and carry on pipelining.
+
+    The confirm callback, if any, is called with the tag of each command
+    once it has been acknowledged.
+    """
+    def __init__(self, pic, window=1, delay=0, confirm=None):
+        self.pic = pic
+        self.tty = pic.tty
+        self.window = max(1, window)
+        self.delay = delay
+        self.confirm = confirm
+        self.pending = []
+        self.fallbacks = 0
+        self.retries = 0
+        self.busy = 0
+    
+    def send(self, cmd, reply="!>", writes=1, tag=None):
+        """
+        Issues a command causing the given number of flash or eeprom write
+        cycles, first collecting replies if the window is full
+        """
+        pipelined = self.window > 1 and self.checked(cmd)
+        while self.pending and (len(self.pending) >= self.window or
+                                not pipelined):
+            self.collect()
+        if pipelined:
+            self.settle()
+    
+        seq = None
+        data = cmd
+        if self.pic.framed:
+            seq, data = self.pic.frame(cmd)
+        self.pending.append((cmd, reply, writes, tag, seq))
+        self.tty.write(data)
+    
+        # the monitor has to finish its writes before anything else
+        # reaches its (2 bytes deep) receive fifo
+        if pipelined:
+            self.tty.drain()
+            self.busy = time.time() + self.delay * writes
+        else:
+            self.flush()
+    
+    def settle(self):
+        """
+        Waits until the monitor may be done with the writes of the last
+        command sent: its reply arrived, or the write delay elapsed
+        """
+        while self.pending:
+            left = self.busy - time.time()
+            if left <= 0:
+                return
+            if not self.tty.buffer and \
+               not self.tty.wait(select.POLLIN, left):
+                return
+            self.collect()
+    
+    def checked(self, cmd):
+        """
+        Tells whether the monitor rejects a command whose arguments were
+        corrupted or cut short, so that it may be pipelined
+        """
+        return self.pic.framed or \
+               cmd[:1] in "WLl" and self.pic.getMonVersion() >= 14
+    
+    def collect(self):
+        """
+        Matches the reply of the oldest outstanding command
+        """
+        cmd, reply, writes, tag, seq = self.pending[0]
+        if seq is not None:
+            if self.pic.readFrame(seq, 0) is None:
+                self.replay()
+                return
+        else:
+            if not self.match(cmd, reply, writes, tag):
+                return
+            if self.pic.stats:
+                self.pic.stats.prompt()
+        self.retries = 0
+        self.pending.pop(0)
+        if self.confirm and tag is not None:
+            self.confirm(*tag)
+    
+    def match(self, cmd, reply, writes, tag):
+        """
+        Reads the reply of the oldest outstanding command. Returns False,
+        having sent it again or fallen back to stop-and-wait, if it is not
+        the expected one.
+        """
+        for c in reply:
+            c1 = self.tty.read(blocking=1)
+            if c1 == c:
+                continue
+            if self.window > 1:
+                self.fallback()
+                return False
+    
+            # the monitor rejected a corrupted command, send it again
+            if c1 == '?' and self.tty.read(blocking=1) == '>' \
+                    and self.retries < 3:
+                self.retries += 1
+                self.pending.pop(0)
+                if self.pic.stats:
+                    self.pic.stats.prompt(False)
+                self.send(cmd, reply, writes, tag)
+                return False
+    
+            print "Bootmon replied with %s to %s" % (repr(c1), cmd)
+            raise Exception("Got reply %s, wanted %s" % (repr(c1), repr(c)))
+        return True
+    
+    def flush(self):
+        """
+        Waits for every outstanding command to be acknowledged
+        """
+        while self.pending:
+            self.collect()
+    
+    def fallback(self):
+        """
+        Resynchronizes with the monitor and replays unconfirmed commands
+        in stop-and-wait mode
+        """
+        log("\nUnexpected reply, falling back to stop-and-wait\n")
+        self.fallbacks += 1
+        if self.pic.stats:
+            self.pic.stats.fallbacks += 1
+        pending = self.pending
+        self.pending = []
+        self.window = 1
+        self.pic.resync()
+        for cmd, reply, writes, tag, seq in pending:
+            self.send(cmd, reply, writes, tag)
+    
+    def replay(self):
+        """
+        Sends the oldest outstanding frame again once the monitor is quiet,
+        followed by every later one, as those may have been rejected too
+        """
+        self.retries += 1
+        if self.retries >= defaultFrameAttempts:
+            raise BadConnection("No valid reply to %d frames in a row" %
+                                self.retries)
+        log("\nBad reply, sending %d frame(s) again\n" % len(self.pending))
+        self.pic.frameError(self.retries)
+        pending = self.pending
+        self.pending = []
+        for cmd, reply, writes, tag, seq in pending:
+            self.send(cmd, reply, writes, tag)
+    
 class PIC:
     """
     Abstract class for interfacing with a PIC chip via local serial
@@ -196,44 +788,137 @@ class PIC:
         self.options = options
     
         self.tty = Tty(**options)
+    
+        # line speed the monitor was found at, given back by leave()
+        self.foundSpeed = self.tty.speed
+    
+        # statistics, only kept when they are reported
+        self.stats = None
+        if options['stats']:
+            self.stats = Stats()
+            self.tty.stats = self.stats
+            sessions.append(self)
+    
+        # monitor version, asked for when first needed
+        self.version = None
+    
+        # whether values are exchanged as raw bytes rather than hex digits,
+        # and commands sent in frames, numbered by seq
+        self.binary = False
+        self.framed = False
+        self.seq = 0
+    
+        # user feedback, called with the number of words transferred so
+        # far out of self.total
+        self.progress = progress
+        self.total = 0
         
     def connect(self, callback=None):
         """
         Repeatedly sends an invalid character (space) to PicForth monitor,
         and looks for '?>' response. Barfs if any other chars are received,
         which indicates incorrect serial parameters (eg baudrate)
+
+        When a reset line is configured, the PIC is first reset into its
+        monitor. Raises Timeout if the monitor does not answer within the
+        connection timeout.
         """
+        start = time.time()
+        timeout = self.options['connecttimeout']
+        if self.options['reset']:
+            self.reset()
+            timeout = timeout or resetConnectTimeout
+        deadline = timeout and time.time() + timeout
+    
+        # the monitor answers as soon as it gets a space, anything after
+        # its prompt answers an earlier one
+        quiet = 0.01 + 40.0 / self.tty.speed
+        garbage = ""
         attempts = 0
         while True:
+            if deadline and time.time() > deadline:
+                raise Timeout(self.diagnostic(garbage))
             try:
                 self.tty.write(" ")
-                c = self.tty.read()
+                c = self.tty.read(timeout=0.1)
                 if c == '':
                     if callback:
                         callback()
-                        time.sleep(0.1)
                     continue
         
-                if c not in ['?', '>']:
-                    raise BadConnection("Invalid reply char: check line settings")
-        
-                #print "Connecting, bootmon sent %s" % repr(c)
-        
                 # connected, now drain rx
                 while 1:
-                    time.sleep(0.1)
-                    c = self.tty.read()
-                    if c == '':
-                        break
                     if c not in ['?', '>']:
+                        garbage = (garbage + c)[-16:]
                         raise BadConnection("Invalid reply char: check line settings")
-                    #print "Connecting, bootmon sent %s" % repr(c)
+                    c = self.tty.read(timeout=quiet)
+                    if c == '':
+                        break
                 break
             except BadConnection:
                 attempts += 1
                 if attempts % 100 == 0:
                     attempts = 0
-                    callback(True)
+                    if callback:
+                        callback(True)
+        if self.stats:
+            self.stats.connect = time.time() - start
+    
+    def diagnostic(self, garbage):
+        """
+        Explains why connect() could not reach the monitor
+        """
+        where = "%s at %d bps" % (self.options['port'], self.tty.speed)
+        if garbage:
+            return ("Unexpected characters %s on %s: check the line speed" %
+                    (repr(garbage), where))
+        if self.options['reset']:
+            return ("No answer from the monitor on %s after resetting the "
+                    "PIC: check the cable, the power and the wiring of "
+                    "the %s line to MCLR" % (where, self.options['reset']))
+        return ("No answer from the monitor on %s: check the cable and the "
+                "power, and reset the PIC so that its monitor starts" % where)
+    
+    def reset(self):
+        """
+        Pulses the reset line(s) so that the PIC starts its monitor, and
+        forgets anything it sent meanwhile
+        """
+        self.tty.pulse(resetLines[self.options['reset']],
+                       self.options['resettime'] / 1000.0)
+        self.tty.flush()
+    
+    def resync(self, attempts=20):
+        """
+        Brings the monitor back to its prompt after a protocol error: lets
+        the line settle, discards whatever was received, then sends spaces
+        until the monitor answers '?>'
+        """
+        reply = "?"
+        for i in range(attempts):
+            time.sleep(0.1)
+            self.tty.flush()
+    
+            # a silent monitor is still swallowing the arguments of a
+            # truncated command, feed it faster (framed mode is only left
+            # after four spaces in a row)
+            self.tty.write(reply and " " * (self.framed and 4 or 1) or " " * 8)
+            reply = ""
+            while 1:
+                c = self.tty.read(timeout=0.1 + discardTime)
+                if c == '':
+                    break
+                reply += c
+            if reply.endswith("?>"):
+                if self.stats:
+                    self.stats.abandon()
+                # the unknown command brought the monitor back to ascii
+                if self.binary:
+                    framed = self.framed
+                    self.binary = self.framed = False
+                    self.setBinary(True, framed)
+                return
+        raise BadConnection("Monitor does not answer any more")
     
     def download(self, hexfile=sys.stdin, **kw):
         """
@@ -247,209 +932,917 @@ class PIC:
         if not isinstance(hexfile, Hexfile):
             hexfile = Hexfile(**options)
     
-        # send down a series of 'F' commands
-        i = 0
-    
         # ask serial monitor where we should write our start vector
         vector = self.getMonVector()
-        print "Serial monitor wants boot vector written to 0x%x" % vector
-        
-        # compute values for determining address legality
-        vecRomStart = "%04X" % (vector - 4)
-        vecRomEnd = "%04X" % (vector - 1)
-        #vecAsciiStart = "%04X" % vector
-        vecAsciiEnd = "%04X" % (vector + 3)
-        cfgStart = "2000"
-        cfgEnd = "2100"
-        eeStart = "2100"
-        eeEnd = "2200"
-    
-        for addr, val in hexfile.ascdata:
-            # relocate addresses 0-3 to vector instead
-            if addr < "0004":
-                addrOld = addr
-                addr = "%04X" % (int(addr, 16) + vector)
-                print "Relocated %s from %s to %s" % (val, addrOld, addr)
-            
-            # intercept eeprom addresses
-            if addr >= eeStart and addr < eeEnd:
-                #print "Want to set eeprom %s = %s" % (addr, val)
-                addr = addr[2:4]
-                val = val[2:4]
-                self.emem_write(addr, val)
-                continue
+        self.negotiate()
+        log("Serial monitor wants boot vector written to 0x%x\n" % vector)
+        plan = self.plan(hexfile, vector)
+    
+        # only send what differs from the device contents
+        if options['delta']:
+            manifest, writes = self.delta(plan, vector)
+            log("%d of %d words differ from the device contents\n" % (
+                len(writes), len(plan)))
+            manifest.save(False)
+        else:
+            writes = plan
+    
+        # record progress, and skip what an interrupted download of the
+        # same plan through the same port already wrote
+        journal = Journal(self.options['port'], planDigest(writes),
+                          options['journaldir'])
+        start = 0
+        if options['resume']:
+            start = self.resumePoint(writes, journal)
+    
+        # send down a series of commands, several of them in flight
+        engine = Pipeline(self, int(options['window']),
+                          int(options['writedelay']) / 1000.0,
+                          journal.confirm)
+        frames = self.frames(writes[start:])
+        self.total = sum([words for cmd, words, cycles, entries in frames])
+        i = 0
+        entry = start
     
-            # vet address
-            #if (addr < "0004") or (addr >= "0E40" and addr <= "0FFF"):
-            if (addr < "0004") \
-                    or (addr >= cfgStart and addr <= cfgEnd) \
-                    or (addr >= vecRomStart and addr <= vecRomEnd) \
-                    or (addr > vecAsciiEnd and addr < eeEnd):
-                #print "Skipping invalid setting %s->%s" % (addr, val)
-                continue
-            else:
-                self.pmem_write(addr, val)
+        for cmd, words, cycles, entries in frames:
+            engine.send(cmd, writes=cycles, tag=(entry, entry + entries))
+            entry += entries
     
-                # display user feedback
+            # display user feedback
+            for j in range(words):
                 i += 1
-                if i % 16 == 0:
-                    if i % 256 == 0:
-                        if i % 1024 == 0:
-                            log("%dk\n" % (i / 1024))
-                        else:
-                            log("*")
-                    else:
-                        log(".")
+                self.progress(i)
     
-                    sys.stdout.flush()
+        engine.flush()
     
         if i % 1024:
             log('\n')
     
+        # a command corrupted in a way its checksum did not catch may have
+        # been run before the protocol error was noticed
+        if engine.fallbacks:
+            log("Fell back to stop-and-wait after a protocol error\n")
+            self.repair(writes, engine)
+        journal.clear()
+    
         log("Successfully transferred %d bytes\n" % i)
     
+        # the device now holds the new image
+        if options['delta']:
+            manifest.words.update(dict(plan))
+            manifest.vector = vector
+            manifest.save(True)
+    
         log("Download successful\n")
+        return plan
     
-    def getMonVector(self):
+    def repair(self, writes, engine):
         """
-        Asks serial monitor where we should place our vector
+        Checks the words of a download plan against the device contents,
+        and writes the rows which differ again
+        """
+        log("Checking the words written:\n")
+        total = self.total
+        bad = self.verify(writes)
+        log("\n")
+        if bad:
+            log("%d words differ, first one at 0x%x, writing them again\n" %
+                (len(bad), bad[0]))
+            rows = dict([(addr & ~3, True) for addr in bad])
+            again = [(addr, val) for (addr, val) in writes
+                     if rows.has_key(addr & ~3)]
+            for cmd, words, cycles, entries in self.frames(again):
+                engine.send(cmd, writes=cycles)
+            engine.flush()
+            bad = self.verify(again)
+            log("\n")
+        self.total = total
+        if bad:
+            raise BadConnection("%d words differ after writing them again, "
+                                "first one at 0x%x" % (len(bad), bad[0]))
+    
+    def resumePoint(self, writes, journal):
+        """
+        Returns the index of the first entry of a download plan still to be
+        written according to the journal. The words written by the last
+        acknowledged command are checked first, and written again unless
+        the device holds them.
         """
-        self.tty.write("o")
+        if not journal.done:
+            log("No interrupted download of this image through %s\n" %
+                journal.port)
+            return 0
+        total = self.total
+        bad = self.verify(writes[journal.last:journal.done])
+        self.total = total
+        if bad:
+            log("\nWords at 0x%x do not match, writing them again\n" %
+                bad[0])
+            return journal.last
+        log("\nResuming after %d of %d words\n" % (journal.done, len(writes)))
+        return journal.done
+    
+    def plan(self, hexfile, vector):
+        """
+        Lists the (address, value) pairs of an image to write to the
+        device, eeprom bytes being found at 0x2100 and above. The reset
+        vector is relocated to the one of the serial monitor, and words
+        belonging to the monitor or to the configuration are left out.
+        """
+        # compute values for determining address legality
+        vecRomStart = vector - 4
+        vecRomEnd = vector - 1
+        vecAsciiEnd = vector + 3
+        cfgStart = 0x2000
+        cfgEnd = 0x2100
+        eeStart = 0x2100
+        eeEnd = 0x2200
     
-        # expect ack
-        c = self.tty.read(blocking=1)
-        if c != '!':
-            raise Exception("Wanted '!', got %s" % repr(c))
+        plan = []
     
-        chars = []
-        for i in range(4):
-            chars.append(self.tty.read(blocking=1))
-        addr = int("".join(chars), 16)
-        
-        # expect prompt
-        c = self.tty.read(blocking=1)
-        if c != '>':
-            raise Exception("Wanted '>', got %s" % repr(c))
+        for addr, val in hexfile.words():
+            # relocate addresses 0-3 to vector instead
+            if addr < 4:
+                log("Relocated %04X from %04X to %04X\n" % (
+                    val, addr, addr + vector))
+                addr += vector
+    
+            # the vector only holds relocated words
+            elif vector <= addr <= vecAsciiEnd:
+                continue
+            
+            # intercept eeprom addresses
+            if eeStart <= addr < eeEnd:
+                plan.append((addr, val & 0xff))
     
-        return addr
+            # vet address
+            elif not (cfgStart <= addr <= cfgEnd
+                      or vecRomStart <= addr <= vecRomEnd
+                      or vecAsciiEnd < addr < eeEnd):
+                plan.append((addr, val))
     
-    def upload(self, hexfile=sys.stdout, **kw):
+        return plan
+    
+    def verify(self, plan):
         """
-        Uploads image from device, outputs in Intel hex format
+        Checks the words of a download plan against the device contents,
+        returns the list of addresses which differ. Monitors from version
+        10 on checksum each run of consecutive addresses, and only the
+        words of mismatching runs are read back, otherwise every word is.
         """
-        image = {}
-        imageSize = kw['size']
-        
-        # suck 8k of program mem, plus flash
-        for i in (range(0, imageSize) + range(0x2000, 0x2100)):
-        #for i in range(0x100):
-            image[i] = self[i]
-    
-            if (i+1) % 16 == 0:
-                if (i+1) % 256 == 0:
-                    if (i+1) % 1024 == 0:
-                        log("%dk\n" % ((i+1)/1024))
-                    else:
-                        log("*")
-                else:
-                    log(".")
-        log("\n")
-    
-        # create hexfile records - need to write as little-endian words
-        hexlines = []
-        addresses = image.keys()
-        addresses.sort()
-        for addr in (range(0, imageSize, 8) + range(0x2000, 0x2100, 8)):
-        #for addr in range(0, 0x100, 8):
+        plan = sorted(plan)
+        self.total = len(plan)
+        bad = []
+        done = [0]
+        def feedback(n):
+            for i in range(n):
+                done[0] += 1
+                self.progress(done[0])
+        if self.getMonVersion() >= 10:
+            check = self.checkRun
+        else:
+            check = self.compareRun
+        i = 0
+        while i < len(plan):
+            # check runs of consecutive addresses at once
+            j = i + 1
+            while j < len(plan) and plan[j][0] == plan[j - 1][0] + 1:
+                j += 1
+            bad.extend(check(plan[i:j], feedback))
+            i = j
+        return bad
+    
+    def compareRun(self, run, feedback):
+        """
+        Reads back a run of consecutive words of a download plan, returns
+        the addresses which differ
+        """
+        values = self.readRange(run[0][0], run[-1][0] + 1, feedback)
+        bad = []
+        for (addr, val), got in zip(run, values):
+            if addr >= 0x2100:
+                val &= 0xff
+            if got != val & 0x3fff:
+                bad.append(addr)
+        return bad
+    
+    def checkRun(self, run, feedback):
+        """
+        Compares the checksum of a run of consecutive words of a download
+        plan with the device's one, bisecting the run when they differ
+        """
+        if len(run) <= defaultBisectSize:
+            return self.compareRun(run, feedback)
+        start = run[0][0]
+        expected = fletcher(self.wordBytes(start, [val for addr, val in run]))
+        if self.rangeSum(start, start + len(run)) == expected:
+            feedback(len(run))
+            return []
+        half = len(run) / 2
+        return self.checkRun(run[:half], feedback) + \
+               self.checkRun(run[half:], feedback)
+    
+    def frames(self, writes):
+        """
+        Groups a download plan into monitor commands, returning a list of
+        (command, flash words written, write cycles, plan entries) tuples.
+        Consecutive flash words are sent as bursts of up to 4 rows when the
+        monitor knows about the 'W' command, one write cycle per row. In
+        binary mode, single words are sent through 'W' too so that every
+        flash write is checksummed. Runs of a same value are sent as fills
+        when the monitor knows about the 'L' and 'l' commands, and so are
+        single eeprom bytes, so that they are checksummed too.
+        """
+        rows = self.getMonVersion() >= 7
+        fills = self.getMonVersion() >= 11
+        frames = []
+        burst = []
+        i = 0
+        while i <= len(writes):
+            if i < len(writes):
+                addr, val = writes[i]
+                run = fills and self.fillRun(writes, i) or 1
+            else:
+                addr, val, run = None, None, 1
+            if burst and (addr != burst[-1][0] + 1 or not rows or run > 1
+                          or len(burst) == defaultBurstSize):
+                frames.append(self.flashFrame(burst))
+                burst = []
+            if addr is None:
+                break
+            if run > 1 or fills and addr >= 0x2100:
+                frames.append(self.fillFrame(addr, val, run))
+            elif addr >= 0x2100:
+                cmd = "E" + self.arg(addr - 0x2100, 1) + self.arg(val, 1)
+                frames.append((cmd, 0, 1, 1))
+            else:
+                burst.append((addr, val))
+            i += run
+        return frames
     
-            bytes = []           # raw bytes to write
-            haddr = addr * 2     # .hex file addresses are double, since we're writing words
+    def fillRun(self, writes, i):
+        """
+        Returns the number of entries of a download plan starting at index
+        i which are worth a fill command, or 1 if the run is too short
+        """
+        addr, val = writes[i]
+        n = 1
+        while i + n < len(writes) and n < 0x100 and \
+              writes[i + n] == (addr + n, val):
+            n += 1
+        if addr >= 0x2100:
+            minimum = defaultEepromFillMinimum
+        else:
+            minimum = defaultFillMinimum
+        if n < minimum:
+            return 1
+        return n
     
-            # write out length
-            bytes.append(16)
+    def fillFrame(self, addr, val, count):
+        """
+        Builds the command writing val into count consecutive flash words
+        or eeprom bytes
+        """
+        if addr >= 0x2100:
+            data = [addr - 0x2100, count & 0xff, val & 0xff]
+            cmd = "l"
+            words, cycles = 0, count
+        else:
+            data = [addr >> 8, addr & 0xff, count & 0xff, val >> 8 & 0xff,
+                    val & 0xff]
+            cmd = "L"
+            words, cycles = count, (count + 3) / 4
+        cmd += "".join([self.arg(b, 1) for b in data]) + \
+               self.arg(sum(data) % 0x100, 1)
+        return cmd, words, cycles, count
+    
+    def flashFrame(self, burst):
+        """
+        Builds the command writing consecutive (address, value) flash words
+        """
+        addr, val = burst[0]
+        if len(burst) == 1 and not self.binary:
+            return "F%04X%04X" % (addr, val), 1, 1, 1
+        data = []
+        for addr, val in burst:
+            data.extend([val >> 8 & 0xff, val & 0xff])
+        cmd = "W" + self.arg(burst[0][0], 2) + self.arg(len(burst), 1) + \
+              "".join([self.arg(b, 1) for b in data]) + \
+              self.arg(sum(data) % 0x100, 1)
+        return cmd, len(burst), (len(burst) + 3) / 4, len(burst)
+    
+    def upshift(self):
+        """
+        Switches the line to the fastest standard rate the oscillator
+        allows, trying slower ones when a rate does not work
+        """
+        if self.getMonVersion() < 9:
+            log("Monitor cannot change its speed, staying at %d bps\n" %
+                self.tty.speed)
+            return
+        for rate, x, error in baudrates(int(self.options['osc']),
+                                        float(self.options['maxerror'])):
+            if rate <= self.tty.speed:
+                break
+            if self.setBaudrate(rate, x):
+                log("Switched to %d bps (SPBRG=0x%02X, error %.2f%%)\n" % (
+                    rate, x, error))
+                return
+            log("Could not switch to %d bps\n" % rate)
+        log("Staying at %d bps\n" % self.tty.speed)
+    
+    def setBaudrate(self, rate, x):
+        """
+        Asks the monitor to use SPBRG value x and follows it at the given
+        rate. Returns False, back at the previous rate, if the monitor could
+        not be heard at the new one.
+        """
+        old = self.tty.speed
+        self.tty.write("s" + self.arg(x, 1))
+        self.expect('!')
+        self.tty.setSpeed(rate)
+    
+        # let the monitor change its own rate before confirming
+        time.sleep(0.01)
+        self.tty.write("U")
+        deadline = time.time() + 0.3
+        while time.time() < deadline:
+            c = self.tty.read(timeout=deadline - time.time())
+            if c == '>':
+                if self.stats:
+                    self.stats.prompt()
+                return True
+            if c:
+                break
     
-            # write out address field
-            bytes.append(haddr / 0x100)
-            bytes.append(haddr % 0x100)
+        # the monitor gives up after 500ms, then prompts at the old rate
+        self.tty.setSpeed(old)
+        self.resync()
+        return False
     
-            # write out record type
-            bytes.append(0)
+    def negotiate(self):
+        """
+        Switches the session to binary mode, framed if asked for, if both
+        sides agree
+        """
+        if self.options['binary'] and self.getMonVersion() >= 8:
+            framed = self.options['framed'] and self.getMonVersion() >= 13
+            if self.options['framed'] and not framed:
+                log("Monitor does not know framed mode\n")
+            self.setBinary(True, framed)
     
-            # write out data bytes
-            for j in range(addr, addr+8):
-                val = image[j]
-                #log("%x=%x\n" % (j, val))
-                bytes.append(val % 0x100)   # lsb
-                bytes.append(val / 0x100)   # msb
+    def getDeviceId(self):
+        """
+        Reads the 4 bytes device identifier from the eeprom, storing a
+        random one first if the device has none yet
+        """
+        addr = int(self.options['idaddr'])
+        ident = [self.emem_read(addr + i) for i in range(4)]
+        if ident in ([0xff] * 4, [0] * 4):
+            ident = [random.randrange(256) for i in range(4)]
+            for i in range(4):
+                self.emem_write("%02X" % (addr + i), "%02X" % ident[i])
+            log("Assigned identifier %s to device\n" % "".join(
+                ["%02X" % b for b in ident]))
+        return "".join(["%02X" % b for b in ident])
+    
+    def delta(self, plan, vector):
+        """
+        Filters a download plan down to the words which differ from the
+        device contents, as recorded in the device manifest or, if it is
+        missing or stale, as read back from the device
+        """
+        # the device identifier must survive the download, and must not
+        # replace data of the image
+        idStart = 0x2100 + int(self.options['idaddr'])
+        for addr, val in plan:
+            if idStart <= addr < idStart + 4:
+                raise InvalidAddress(
+                    "The image stores data at eeprom address 0x%x, where "
+                    "the device identifier is kept: choose another one "
+                    "with --id-address" % (addr - 0x2100))
+    
+        devid = self.getDeviceId()
+        manifest = Manifest(devid, self.options['manifestdir'])
+    
+        if manifest.fresh(vector) and self.spotCheck(manifest):
+            changed = [addr for (addr, val) in plan
+                       if manifest.words.get(addr) != val]
+        else:
+            log("No valid manifest for device %s, comparing with its contents:\n"
+                % devid)
+            changed = self.verify(plan)
+            log("\n")
+            differ = dict([(addr, True) for addr in changed])
+            manifest.words = dict([(addr, val) for (addr, val) in plan
+                                   if not differ.has_key(addr)])
+    
+        # 16F87xA parts program flash by 4 words rows, so a changed word
+        # means rewriting its whole row
+        rows = dict([(addr & ~3, True) for addr in changed if addr < 0x2000])
+        changed = dict([(addr, True) for addr in changed])
+        return manifest, [(addr, val) for (addr, val) in plan
+                          if changed.has_key(addr) or rows.has_key(addr & ~3)]
+    
+    def spotCheck(self, manifest, samples=8):
+        """
+        Reads back a few words recorded in the manifest to make sure that
+        nobody reprogrammed the device in between
+        """
+        addresses = manifest.words.keys()
+        addresses.sort()
+        step = max(1, len(addresses) / samples)
+        for addr in addresses[::step]:
+            if self[addr] != manifest.words[addr] & 0x3fff:
+                return False
+        return True
     
-            # compute and write out checksum
-            cksm = (0x100 - (sum(bytes) % 0x100)) % 0x100
-            bytes.append(cksm)
-            
-            # now can output the record
-            hexlines.append(":" + "".join([("%02X" % b) for b in bytes]))
+    def getMonVector(self):
+        """
+        Asks serial monitor where we should place our vector
+        """
+        data = self.transact("o", 2)
+        return data[0] << 8 | data[1]
     
-        # now spit out the 'special line'
-        hexlines.append(":00000001FF")
+    def upload(self, hexfile=sys.stdout, **kw):
+        """
+        Uploads image from device, outputs in Intel hex format.
+
+        Only the (start, end, tail) address ranges given as 'ranges' are
+        read, the whole program memory and eeprom by default. Reading a
+        tail range stops at its first erased block. Erased words are left
+        out, and records are written as soon as their words are read.
+        """
+        ranges = kw.get('ranges') or [(0, kw['size'], False),
+                                      (0x2100, 0x2200, False)]
+        self.total = sum([end - start for start, end, tail in ranges])
     
-        # assemble into hex file image
-        heximage = "\n".join(hexlines) + "\n"
+        if self.getMonVersion() < 6:
+            log("Monitor cannot read blocks, reading word by word\n")
+        self.negotiate()
     
-        # and dump it
         if isinstance(hexfile, str):
             base, ext = os.path.splitext(hexfile)
             if ext == '':
                 hexfile += ".hex"
             hexfile = file(hexfile, "w")
-        hexfile.write(heximage)
+        writer = HexWriter(hexfile)
+        
+        done = [0]
+        def feedback(n):
+            for i in range(n):
+                done[0] += 1
+                self.progress(done[0])
+        def uploadRanges():
+            for start, end, tail in ranges:
+                if not tail:
+                    self.uploadRange(start, end, writer, feedback)
+                    continue
+                for addr in range(start, end, defaultBlockSize):
+                    block = min(end, addr + defaultBlockSize)
+                    if not self.uploadRange(addr, block, writer, feedback):
+                        feedback(end - block)
+                        break
+        self.restoring(uploadRanges)
+        writer.close()
+        log("\n")
+    
+    def uploadRange(self, start, end, writer, feedback):
+        """
+        Reads words start to end (excluded) of the device memory into a
+        HexWriter, leaving out erased words. Monitors from version 10 on
+        tell whether a range is erased through a single checksum, which
+        lets large erased ranges be skipped. Returns False if the range
+        was erased.
+        """
+        if self.getMonVersion() >= 10:
+            blank = [erased(start)] * (end - start)
+            if self.rangeSum(start, end) == \
+                    fletcher(self.wordBytes(start, blank)):
+                feedback(end - start)
+                return False
+            if end - start > defaultBlockSize:
+                middle = start + (end - start) / 2
+                return self.uploadRange(start, middle, writer, feedback) | \
+                       self.uploadRange(middle, end, writer, feedback)
+        used = False
+        for addr, val in zip(range(start, end),
+                             self.readRange(start, end, feedback)):
+            if val != erased(addr):
+                writer.add(addr, val)
+                used = True
+        return used
+    
+    def watch(self, registers, output=sys.stdout, **kw):
+        """
+        Samples file registers, given as (label, address) pairs, as fast as
+        the line allows or every 'period' milliseconds, until 'samples'
+        samples have been taken or the user interrupts it. Each sample is
+        written to output as a line of comma separated values, the time
+        in seconds since the first sample being followed by the value of
+        every register.
+        """
+        period = kw.get('period', 0) / 1000.0
+        samples = kw.get('samples', 0)
+        addrs = [addr for label, addr in registers]
+    
+        if self.getMonVersion() < 12:
+            log("Monitor cannot read several registers at once, reading "
+                "them one by one\n")
+        self.negotiate()
+    
+        if isinstance(output, str):
+            output = file(output, "w")
+        output.write(",".join(["time"] + [label for label, addr
+                                          in registers]) + "\n")
+        output.flush()
+    
+        taken = [0]
+        start = time.time()
+        def sample():
+            try:
+                while not samples or taken[0] < samples:
+                    when = time.time()
+                    values = self.readRegisters(addrs)
+                    output.write(",".join(["%.4f" % (when - start)] +
+                                          [str(v) for v in values]) + "\n")
+                    output.flush()
+                    taken[0] += 1
+                    self.progress(taken[0])
+                    if period:
+                        time.sleep(max(0, start + taken[0] * period -
+                                       time.time()))
+            except KeyboardInterrupt:
+                # a reply may have been cut short
+                log("\nStopped by user")
+                self.resync()
+        self.restoring(sample)
+        log("\n%d samples in %.1f seconds\n" % (taken[0], time.time() - start))
+        return taken[0]
+    
+    def restoring(self, function):
+        """
+        Runs function, then leaves the monitor as we found it (see leave()),
+        even when function fails
+        """
+        try:
+            function()
+        except:
+            info = sys.exc_info()
+            try:
+                self.resync()
+                self.leave()
+            except Exception, e:
+                log("\nCould not leave the monitor as found: %s\n" % e)
+            raise info[0], info[1], info[2]
+        self.leave()
+    
+    def leave(self):
+        """
+        Leaves the monitor as we found it: in ascii mode, and at the line
+        speed it was found at if upshift() changed it, as the next session
+        expects
+        """
+        if self.binary:
+            self.setBinary(False)
+        if self.tty.speed != self.foundSpeed:
+            x, error = spbrg(int(self.options['osc']), self.foundSpeed)
+            if not self.setBaudrate(self.foundSpeed, x):
+                raise BadConnection("Monitor could not be brought back to "
+                                    "%d bps" % self.foundSpeed)
+            log("Switched back to %d bps\n" % self.foundSpeed)
+    
+    def readRegisters(self, addrs):
+        """
+        Reads file registers of any bank, several at once from version 12
+        of the monitor on (runs of at least 16 consecutive registers as
+        blocks), otherwise one by one through the 'm' command, which only
+        reaches banks 0 and 1
+        """
+        if self.getMonVersion() >= 12:
+            # a run of consecutive registers costs a single block read
+            # whatever its length, the others are gathered by up to 16
+            runs = []
+            for addr in addrs:
+                if runs and addr == sum(runs[-1]) and runs[-1][1] < 0x100:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([addr, 1])
+            values = {}
+            scattered = []
+            for start, count in runs:
+                run = range(start, start + count)
+                if count >= defaultGatherSize:
+                    values.update(zip(run, self.ram_block(start, count)))
+                else:
+                    scattered.extend(run)
+            for i in range(0, len(scattered), defaultGatherSize):
+                gathered = scattered[i:i + defaultGatherSize]
+                values.update(zip(gathered, self.ram_gather(gathered)))
+            return [values[addr] for addr in addrs]
+        for addr in addrs:
+            if addr > 0xff:
+                raise InvalidAddress(
+                    "Monitor cannot read file register 0x%x" % addr)
+        return [self.ram_read(addr) for addr in addrs]
+    
+    def ram_gather(self, addrs, retries=3):
+        """
+        Reads up to 16 file registers, from any bank
+        """
+        data = []
+        for addr in addrs:
+            data.extend([addr >> 8 & 1, addr & 0xff])
+        cmd = "g" + self.arg(len(addrs), 1) + \
+              "".join([self.arg(b, 1) for b in data]) + \
+              self.arg(sum(data) % 0x100, 1)
+        for attempt in range(retries):
+            values = self.readBlock(cmd, len(addrs))
+            if values is not None:
+                return values
+            log("Checksum error reading file registers\n")
+            if self.stats:
+                self.stats.retries += 1
+        raise Exception("Cannot read file registers")
+    
+    def ram_block(self, addr, count, retries=3):
+        """
+        Reads count (at most 256) consecutive file registers, from any bank
+        """
+        for attempt in range(retries):
+            data = self.readBlock("a" + self.arg(addr, 2) +
+                                  self.arg(count & 0xff, 1), count)
+            if data is not None:
+                return data
+            log("Checksum error reading file registers at 0x%x\n" % addr)
+            if self.stats:
+                self.stats.retries += 1
+        raise Exception("Cannot read file registers at 0x%x" % addr)
+    
+    def ram_read(self, addr):
+        """
+        Reads a file register of banks 0 and 1
+        """
+        return self.transact("m" + self.arg(addr, 1), 1)[0]
     
     def pmem_write(self, addr, val):
         """
         Writes a word to program memory
         """
-        cmd = "F%s%s" % (addr, val)
-        #print cmd
-        self.tty.write(cmd)
+        self.transact("F" + self.arg(int(addr, 16), 2) +
+                      self.arg(int(val, 16), 2))
     
-        # seek reply chars from bootmon
-        for c in ['!', '>']:
-            c1 = self.tty.read(blocking=1)
-            if c1 != c:
-                print "Bootmon replied with %s, wanted '!'" % repr(c1)
-                raise Exception("Got reply %s, wanted %s" % (
-                    repr(c1), repr(c)))
+    def readRange(self, start, end, feedback=None):
+        """
+        Reads words start to end (excluded) of the device memory, eeprom
+        being found from 0x2100, using block reads when the monitor
+        supports them. feedback is called with the number of words read
+        after each transfer.
+        """
+        values = []
+        addr = start
+        while addr < end:
+            if self.getMonVersion() >= 6:
+                n = min(end - addr, defaultBlockSize)
+                if addr < 0x2000:
+                    values.extend(self.pmem_block(addr, n))
+                else:
+                    values.extend(self.emem_block(addr - 0x2100, n))
+            else:
+                n = 1
+                values.append(self[addr])
+            addr += n
+            if feedback:
+                feedback(n)
+        return values
+    
+    def pmem_block(self, addr, count, retries=3):
+        """
+        Reads count (at most 256) consecutive words of program memory
+        """
+        for attempt in range(retries):
+            data = self.readBlock("r" + self.arg(addr, 2) +
+                                  self.arg(count & 0xff, 1), count * 2)
+            if data is not None:
+                return [data[i] << 8 | data[i + 1]
+                        for i in range(0, len(data), 2)]
+            log("Checksum error reading program memory at 0x%x\n" % addr)
+            if self.stats:
+                self.stats.retries += 1
+        raise Exception("Cannot read program memory at 0x%x" % addr)
+    
+    def emem_block(self, addr, count, retries=3):
+        """
+        Reads count (at most 256) consecutive bytes of data eeprom
+        """
+        for attempt in range(retries):
+            data = self.readBlock("d" + self.arg(addr, 1) +
+                                  self.arg(count & 0xff, 1), count)
+            if data is not None:
+                return data
+            log("Checksum error reading eeprom at 0x%x\n" % addr)
+            if self.stats:
+                self.stats.retries += 1
+        raise Exception("Cannot read eeprom at 0x%x" % addr)
+    
+    def rangeSum(self, start, end):
+        """
+        Returns the Fletcher sums of words start to end (excluded) of the
+        device memory, eeprom being found from 0x2100
+        """
+        if start >= 0x2100:
+            return self.emem_sum(start - 0x2100, end - start)
+        return self.pmem_sum(start, end - start)
     
-    def pmem_read(self, addr):
+    def wordBytes(self, start, values):
         """
-        Reads program memory at chosen location
+        Lists the bytes checksummed by the monitor for values found from
+        address start
+        """
+        if start >= 0x2100:
+            return [val & 0xff for val in values]
+        data = []
+        for val in values:
+            data.extend([val >> 8 & 0x3f, val & 0xff])
+        return data
+    
+    def pmem_sum(self, addr, count):
         """
-        # issue read command
-        cmd = "f%04X" % addr
+        Returns the Fletcher sums of count consecutive words of program
+        memory
+        """
+        return tuple(self.transact("c" + self.arg(addr, 2) +
+                                   self.arg(count, 2), 2))
+    
+    def emem_sum(self, addr, count):
+        """
+        Returns the Fletcher sums of count (at most 256) consecutive bytes
+        of data eeprom
+        """
+        return tuple(self.transact("k" + self.arg(addr, 1) +
+                                   self.arg(count & 0xff, 1), 2))
+    
+    def readBlock(self, cmd, count):
+        """
+        Sends a block read command and reads its count bytes, followed by
+        their checksum. Returns None if the checksum does not match.
+        """
+        data = self.transact(cmd, count + 1)
+        if sum(data[:-1]) % 0x100 != data[-1]:
+            return None
+        return data[:-1]
+    
+    def transact(self, cmd, size=0):
+        """
+        Sends a command and returns the size bytes of its reply, read
+        between the ack and the prompt. In framed mode, the command is sent
+        again until its reply checks.
+        """
+        if self.framed:
+            return self.transactFrame(cmd, size)
         self.tty.write(cmd)
-        
-        # read back ack/nack
-        c = self.tty.read(blocking=1)
-        if c != '!':
-            raise Exception("Bad response from program memory read")
-        
-        # ack'ed ok, read nybbles
+        self.expect('!')
+        data = [self.readValue(1) for i in range(size)]
+        self.expect('>')
+        return data
+    
+    def frame(self, cmd):
+        """
+        Wraps a command into a frame with the next sequence number, returns
+        both
+        """
+        self.seq = (self.seq + 1) & 0xff
+        data = [len(cmd), self.seq] + [ord(c) for c in cmd]
+        return self.seq, ":" + "".join([chr(b) for b in data]) + \
+               chr(sum(data) & 0xff)
+    
+    def transactFrame(self, cmd, size):
+        """
+        Sends a command in a frame, again and again until its reply checks
+        """
+        seq, frame = self.frame(cmd)
+        for attempt in range(defaultFrameAttempts):
+            self.tty.write(frame)
+            data = self.readFrame(seq, size)
+            if data is not None:
+                return data
+            log("Bad reply to frame %d, sending it again\n" % seq)
+            self.frameError(attempt + 1)
+        raise BadConnection("No valid reply to frame %d after %d attempts" %
+                            (seq, defaultFrameAttempts))
+    
+    def readFrame(self, seq, size):
+        """
+        Reads the reply to frame seq: its sequence number, ack, size bytes,
+        the sum of those and the prompt. Returns the size bytes, or None if
+        the reply does not check or does not come in time.
+        """
+        try:
+            reply = self.tty.read(2, blocking=1)
+            # the monitor rejected the frame itself
+            if reply == "?>":
+                return None
+            reply += self.tty.read(size + 2, blocking=1)
+        except Timeout:
+            return None
+        data = [ord(c) for c in reply[:-2]]
+        if data[0] != seq or reply[1] != '!' or reply[-1] != '>' or \
+           sum(data) & 0xff != ord(reply[-2]):
+            return None
+        if self.stats:
+            self.stats.prompt()
+        return data[2:]
+    
+    def frameError(self, failures):
+        """
+        Waits for the monitor to be quiet after the given number of bad
+        replies in a row, discarding whatever it sends, so that the next
+        frame is not mistaken for the end of a previous one. Every other
+        time, the monitor is brought back to its prompt and to framed mode
+        in case a space found in a lost frame made it leave that mode.
+        """
+        if self.stats:
+            self.stats.retries += 1
+            self.stats.abandon()
+        if failures % 2 == 0:
+            self.resync()
+            return
+        last = '>'
+        deadline = time.time() + self.tty.timeout
+        while time.time() < deadline:
+            data = self.tty.read(4096, timeout=frameQuiet)
+            if data:
+                last = data[-1]
+            elif last == '>':
+                break
+    
+    def arg(self, val, size):
+        """
+        Encodes a command argument of size bytes for the current mode
+        """
+        if self.binary:
+            return "".join([chr(val >> (8 * i) & 0xff)
+                            for i in range(size - 1, -1, -1)])
+        return "%0*X" % (size * 2, val)
+    
+    def readValue(self, size):
+        """
+        Reads a value of size bytes sent in the current mode
+        """
         val = 0
-        for i in range(4):
+        if self.binary:
+            for i in range(size):
+                val = val << 8 | ord(self.tty.read(blocking=1))
+            return val
+        for i in range(size * 2):
             c = self.tty.read(blocking=1).upper()
             if c not in "0123456789ABCDEF":
-                raise Exception("Bad value from program memory read")
-            if c.isdigit():
-                nyb = ord(c) - ord('0')
-            else:
-                nyb = ord(c) - ord('A') + 10
-            val = val << 4 | nyb
+                raise Exception("Bad hex digit %s from monitor" % repr(c))
+            val = val << 4 | int(c, 16)
+        return val
+    
+    def setBinary(self, binary, framed=False):
+        """
+        Switches the monitor to binary or ascii mode, binary mode being
+        framed if asked for
+        """
+        self.transact("b" + self.arg(framed and 2 or binary and 1 or 0, 1))
+        self.binary = binary or framed
+        self.framed = framed
     
-        # expect final '>'
+    def expect(self, wanted):
+        """
+        Reads one character, which must be the wanted one
+        """
         c = self.tty.read(blocking=1)
-        if c != '>':
-            raise Exception("Invalid final response from program memory read")
+        if c != wanted:
+            raise Exception("Wanted %s, got %s" % (repr(wanted), repr(c)))
+        if c == '>' and self.stats:
+            self.stats.prompt()
     
-        return val
+    def getMonVersion(self):
+        """
+        Asks serial monitor for its version, 0 meaning that it is too old
+        to know the 'v' command
+        """
+        if self.version is None:
+            self.tty.write("v")
+            c = self.tty.read(blocking=1)
+            if c == '?':
+                self.version = 0
+            elif c == '!':
+                self.version = self.readValue(1)
+            else:
+                raise Exception("Bad response from version query")
+            self.expect('>')
+        return self.version
+    
+    def pmem_read(self, addr):
+        """
+        Reads program memory at chosen location
+        """
+        data = self.transact("f" + self.arg(addr, 2), 2)
+        return data[0] << 8 | data[1]
     
     def emem_read(self, addr):
         """
@@ -458,66 +1851,60 @@ class PIC:
         if addr > 0xff:
             raise Exception("Invalid eeprom data address 0x%x" % addr)
     
-        # issue read command
-        cmd = "e%02X" % addr
-        self.tty.write(cmd)
-        
-        # read back ack/nack
-        c = self.tty.read(blocking=1)
-        if c != '!':
-            raise Exception("Bad response from program memory read")
-        
-        # ack'ed ok, read nybbles
-        val = 0
-        for i in range(2):
-            c = self.tty.read(blocking=1).upper()
-            if c not in "0123456789ABCDEF":
-                raise Exception("Bad value from program memory read")
-            if c.isdigit():
-                nyb = ord(c) - ord('0')
-            else:
-                nyb = ord(c) - ord('A') + 10
-            val = val << 4 | nyb
-    
-        # expect final '>'
-        c = self.tty.read(blocking=1)
-        if c != '>':
-            raise Exception("Invalid final response from program memory read")
-    
-        return val
+        return self.transact("e" + self.arg(addr, 1), 1)[0]
     
     def emem_write(self, addr, val):
         """
         Writes a word to data eeprom memory
         """
-        cmd = "E%02X%02X" % (int(addr, 16), int(val, 16))
-        #print cmd
-        self.tty.write(cmd)
-    
-        # seek reply chars from bootmon
-        for c in ['!', '>']:
-            c1 = self.tty.read(blocking=1)
-            if c1 != c:
-                print "Bootmon replied with %s, wanted '!'" % repr(c1)
-                raise Exception("Got reply %s, wanted %s" % (
-                    repr(c1), repr(c)))
+        self.transact("E" + self.arg(int(addr, 16), 1) +
+                      self.arg(int(val, 16), 1))
     
     def run_firmware(self):
         """
         Issues 'O' command to launch firmware
         """
         #self.tty.write("X0005")
-        self.tty.write("O")
+        if self.framed:
+            self.tty.write(self.frame("O")[1])
+        else:
+            self.tty.write("O")
+    
+    def report(self):
+        """
+        Returns the statistics of the session (see Stats.report()) along
+        with its settings
+        """
+        report = self.stats.report()
+        report.update({'port' : self.options['port'],
+                       'speed' : self.tty.speed,
+                       'binary' : self.binary,
+                       'framed' : self.framed,
+                       'version' : self.version})
+        return report
     
     def __getitem__(self, addr):
         if addr < 0x2000:
             return self.pmem_read(addr)
-        elif addr >= 0x2000 and addr < 0x2100:
-            return self.emem_read(addr - 0x2000)
+        elif addr >= 0x2100 and addr < 0x2200:
+            return self.emem_read(addr - 0x2100)
     
         else:
             raise InvalidAddress("Attempted to read from invalid address 0x%x" % addr)
     
+def progress(i):
+    """
+    Displays user feedback once i words have been transferred
+    """
+    if i % 16 == 0:
+        if i % 256 == 0:
+            if i % 1024 == 0:
+                log("%dk\n" % (i / 1024))
+            else:
+                log("*")
+        else:
+            log(".")
+    
 def do_download(**options):
     """
     Attempts to download an intel hex file to a PIC over serial
@@ -540,15 +1927,143 @@ def do_download(**options):
         log("\nDownload aborted by user")
         return
 
-    log("\nConnected sucessfully, now downloading:\n")
+    log("\nConnected sucessfully\n")
+    if options['osc']:
+        pic.upshift()
+    log("Now downloading:\n")
     
     # do the download
-    pic.download(options['path'], **options)
+    try:
+        plan = pic.download(options['path'], **options)
+    except (Timeout, BadConnection, IOError, KeyboardInterrupt):
+        log("\nDownload interrupted, use --resume to continue it\n")
+        raise
+
+    if options['verify']:
+        log("Verifying:\n")
+        bad = pic.verify(plan)
+        log("\n")
+        if bad:
+            err("%d words differ, first one at 0x%x\n" % (len(bad), bad[0]))
+            sys.exit(1)
+        log("Verify successful\n")
 
     # now send command to run prog
     log("Launching application\n")
     pic.run_firmware()
 
+class GangWorker(threading.Thread):
+    """
+    Connects to, downloads to and verifies the board on one serial port
+    """
+    def __init__(self, port, hexfile, options):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.port = port
+        self.hexfile = hexfile
+        self.options = dict(options)
+        self.options['port'] = port
+        self.state = "waiting"
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.elapsed = 0
+    
+    def run(self):
+        start = time.time()
+        try:
+            pic = PIC(**self.options)
+            pic.progress = self.feedback
+            self.pic = pic
+            self.state = "connecting"
+            pic.connect(lambda err=False: None)
+            if self.options['osc']:
+                pic.upshift()
+            self.state = "downloading"
+            plan = pic.download(self.hexfile, **self.options)
+            self.state = "verifying"
+            bad = pic.verify(plan)
+            if bad:
+                raise Exception("%d words differ, first one at 0x%x" % (
+                    len(bad), bad[0]))
+            pic.run_firmware()
+            self.state = "passed"
+        except Exception, e:
+            self.error = str(e) or e.__class__.__name__
+            self.state = "failed"
+        self.elapsed = time.time() - start
+    
+    def feedback(self, i):
+        self.done = i
+        self.total = self.pic.total
+    
+    def status(self):
+        """
+        Short description of the worker progress
+        """
+        name = os.path.basename(self.port)
+        if self.state in ("downloading", "verifying") and self.total:
+            return "%s:%s %d%%" % (name, self.state[0],
+                                   100 * self.done / self.total)
+        return "%s:%s" % (name, self.state)
+
+def expandPorts(spec):
+    """
+    Expands a comma separated list of serial ports, each of which may be
+    a glob pattern
+    """
+    ports = []
+    for item in spec.split(","):
+        matches = glob.glob(item)
+        matches.sort()
+        ports.extend(matches or [item])
+    return ports
+
+def do_gang(**options):
+    """
+    Downloads the same image to boards on several serial ports at once,
+    then reports which ones passed
+    """
+    global quiet
+
+    ports = expandPorts(options['port'])
+    hexfile = Hexfile(**options)
+
+    # per-board messages would be mixed up
+    verbose = not quiet
+    quiet = True
+
+    workers = [GangWorker(port, hexfile, options) for port in ports]
+    for worker in workers:
+        worker.start()
+
+    try:
+        try:
+            while [w for w in workers if w.isAlive()]:
+                if verbose:
+                    err("\r" + "  ".join([w.status() for w in workers]) +
+                        "   ")
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            err("\nGang programming aborted by user\n")
+            sys.exit(1)
+    finally:
+        # the statistics summary goes through log() as well
+        quiet = not verbose
+
+    passed = [w for w in workers if w.state == "passed"]
+    err("\n\n")
+    for w in workers:
+        line = "%-20s %s %6.1fs" % (w.port, w.state == "passed" and "PASS" or
+                                    "FAIL", w.elapsed)
+        if w.error:
+            line += "  " + w.error
+        err(line + "\n")
+    err("%d boards, %d passed, %d failed\n" % (
+        len(workers), len(passed), len(workers) - len(passed)))
+    if len(passed) != len(workers):
+        sys.exit(1)
+
 def do_upload(**options):
     """
     rips the image from a pic, outputs to hex file
@@ -557,7 +2072,7 @@ def do_upload(**options):
     pic = PIC(**options)
 
     # callback routine for connecting
-    def conn_callback():
+    def conn_callback(err=False):
         log(".")
 
     # get a connection
@@ -568,11 +2083,82 @@ def do_upload(**options):
         log("\nUpload aborted by user")
         return
 
-    log("\nConnected sucessfully, now uploading:\n")
+    log("\nConnected sucessfully\n")
+    if options['osc']:
+        pic.upshift()
+    log("Now uploading:\n")
     
     # do the download
     pic.upload(options['path'], **options)
 
+def do_watch(**options):
+    """
+    samples file registers of a pic, outputs them as comma separated values
+    """
+    variables = {}
+    if options['map']:
+        variables = mapVariables(options['map'])
+    try:
+        registers = parseWatch(options['watch'], variables)
+    except ValueError, e:
+        err("%s\n" % e)
+        if options['map'] and not variables:
+            err("%s lists no RAM area, use map-ram-areas before write-map\n"
+                % options['map'])
+        sys.exit(1)
+
+    # create a PIC interface object
+    pic = PIC(**options)
+
+    # callback routine for connecting
+    def conn_callback(err=False):
+        log(".")
+
+    # get a connection
+    log("Connecting to PicForth monitor (press Ctrl-C to abort):")
+    try:
+        pic.connect(conn_callback)
+    except KeyboardInterrupt:
+        log("\nWatch aborted by user")
+        return
+
+    log("\nConnected sucessfully\n")
+    if options['osc']:
+        pic.upshift()
+    log("Now sampling (press Ctrl-C to stop):\n")
+
+    pic.watch(registers, options['path'], **options)
+
+def writeStats(path):
+    """
+    Writes the statistics of every session as JSON into path ('-' for the
+    standard output), and logs a summary of the command latencies
+    """
+    reports = [pic.report() for pic in sessions]
+    for report in reports:
+        log("%s: %d bytes sent, %d received, %d retries in %.1f seconds\n" % (
+            report['port'], report['sent'], report['received'],
+            report['retries'], report['duration']))
+        log("   command  count  mean ms   p50 ms   p90 ms   p99 ms   max ms\n")
+        commands = report['commands'].keys()
+        commands.sort()
+        for cmd in commands:
+            c = report['commands'][cmd]
+            log("   %-7s %6d %8.2f %8.2f %8.2f %8.2f %8.2f\n" % (
+                cmd, c['count'], c['mean'], c['p50'], c['p90'], c['p99'],
+                c['max']))
+    stats = {'date' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+             'sessions' : reports}
+    if path == "-":
+        json.dump(stats, sys.stdout, sort_keys=True, indent=1)
+        sys.stdout.write("\n")
+        return
+    f = file(path + ".tmp", "w")
+    json.dump(stats, f, sort_keys=True, indent=1)
+    f.write("\n")
+    f.close()
+    os.rename(path + ".tmp", path)
+
 def usage(ret=1):
 
     err("Usage: %s [options] [filename]\n" % progname)
@@ -588,20 +2174,90 @@ def usage(ret=1):
     err("       Downloads application to device\n")
     err("   -u, --upload\n")
     err("       Uploads memory image from device\n")
+    err("   -w, --window=n\n")
+    err("       Keeps up to n checksummed write commands in flight (default %d,\n" % defaultWindow)
+    err("       1 waits for the monitor's reply before each command)\n")
+    err("   --write-delay=ms\n")
+    err("       Waits up to ms milliseconds for the previous write before\n")
+    err("       sending a pipelined command (default %d)\n" % defaultWriteDelay)
+    err("   -D, --delta\n")
+    err("       Only writes the words which differ from the device contents\n")
+    err("   --manifest-dir=dir\n")
+    err("       Keeps the last image written to each device in dir\n")
+    err("       (default %s)\n" % defaultManifestDir)
+    err("   --id-address=nn\n")
+    err("       Eeprom address of the 4 bytes device identifier (default 0x%x)\n" %
+        defaultIdAddress)
+    err("   -a, --ascii\n")
+    err("       Keeps the monitor in ascii mode instead of switching to binary\n")
+    err("   -F, --framed\n")
+    err("       Sends commands in checksummed frames, each one being sent again\n")
+    err("       until its reply checks (binary mode, monitors from version 13)\n")
+    err("   --osc=hz\n")
+    err("       Oscillator frequency of the PIC, used to switch to the fastest\n")
+    err("       line speed it allows once connected\n")
+    err("   --max-error=pct\n")
+    err("       Highest acceptable rate error for a line speed (default %.1f%%)\n" %
+        defaultMaxError)
+    err("   --rates\n")
+    err("       Lists usable line speeds and their SPBRG values for --osc\n")
+    err("   -r, --reset=dtr|rts|both\n")
+    err("       Resets the PIC by asserting the given modem control line(s)\n")
+    err("   --reset-time=ms\n")
+    err("       Keeps the reset line(s) asserted ms milliseconds (default %d)\n" %
+        defaultResetTime)
+    err("   --connect-timeout=s\n")
+    err("       Gives up when the monitor cannot be reached within s seconds\n")
+    err("       (default %.1f after a reset, none otherwise)\n" % resetConnectTimeout)
+    err("   -t, --timeout=s\n")
+    err("       Gives up when the monitor does not answer within s seconds\n")
+    err("       (default %.1f)\n" % defaultTimeout)
+    err("   --ranges=start-end,...\n")
+    err("       Only uploads the given word address ranges (eeprom from 0x2100)\n")
+    err("   --map=file.map\n")
+    err("       Only uploads the program memory used by the words of a map\n")
+    err("       (and names the variables given to --watch)\n")
+    err("   -R, --resume\n")
+    err("       Continues an interrupted download of the same image through\n")
+    err("       the same port instead of starting over\n")
+    err("   --journal-dir=dir\n")
+    err("       Records the progress of downloads in dir (default %s)\n" %
+        defaultJournalDir)
+    err("   -V, --verify\n")
+    err("       Reads back the image after downloading it\n")
+    err("   -g, --gang\n")
+    err("       Downloads and verifies the image on every port given to -p\n")
+    err("       at once (comma separated, glob patterns such as\n")
+    err("       '/dev/ttyUSB*' are expanded)\n")
+    err("   -W, --watch=name,...\n")
+    err("       Samples the given file registers (variables of --map, name+n\n")
+    err("       or addresses) and writes their values as comma separated\n")
+    err("       values, until Ctrl-C is pressed\n")
+    err("   --period=ms\n")
+    err("       Samples every ms milliseconds instead of as fast as possible\n")
+    err("   --samples=n\n")
+    err("       Stops watching after n samples\n")
+    err("   --stats=file.json\n")
+    err("       Times every monitor command and writes the latencies, bytes\n")
+    err("       and retries of the session to file.json ('-' for stdout)\n")
     err("   -4, --4k\n")
     err("       Limits uploads to 4k (for 16f88, 16f873 etc\n")
     err("   -2, --2k\n")
     err("       Limits uploads to 2k (for PICs with only 2k\n")
     err("   -1, --1k\n")
     err("       Limits uploads to 1k (for 16f84 and other 1k procs\n")
-    err("One of -u,-d should be specified, if not, '-d' is assumed\n")
+    err("One of -u,-d,-W should be specified, if not, '-d' is assumed\n")
     err("If filename arg is not given, uses stdin or stdout\n")
     err("\n")
     err("Examples:\n")
     err("   cat myprog.hex | ./pfd.py -p /dev/ttyS2 -s 19200\n")
     err("      - downloads myprog.hex via /dev/ttyS2 at 19k2\n")
+    err("   ./pfd.py -g -p '/dev/ttyUSB*' fred.hex\n")
+    err("      - downloads fred.hex to every board on a USB serial port\n")
+    err("   ./pfd.py --map=fred.map -W speed,error --period=10 log.csv\n")
+    err("      - logs the variables speed and error of fred every 10ms\n")
     err("   ./pfd.py fred.hex\n")
-    err("      - downloads fred.hex using defaults (%s at %s)\n" % (defaultDev, defaultBaurate))
+    err("      - downloads fred.hex using defaults (%s at %s)\n" % (defaultDev, defaultBaudrate))
 
     sys.exit(ret)
 
@@ -614,13 +2270,19 @@ def main():
     global quiet
 
     options = dict(defaultOptions)
+    commands = []   # (command, option giving it), in the order given
 
     # extract cmd line args
     try:
         opts, args = getopt.getopt(
             sys.argv[1:],
-            "?hqp:s:421du",
-            ["help", "quiet", "port=", "speed=",
+            "?hqp:s:421duw:DaFVgt:r:RW:",
+            ["help", "quiet", "port=", "speed=", "window=", "write-delay=",
+             "delta", "manifest-dir=", "id-address=", "ascii", "framed",
+             "osc=", "max-error=", "rates", "verify", "gang", "timeout=",
+             "reset=", "reset-time=", "connect-timeout=", "ranges=", "map=",
+             "resume", "journal-dir=", "watch=", "period=", "samples=",
+             "stats=",
              "4k", "2k", "1k",
              "download", "upload",
              ])
@@ -647,6 +2309,88 @@ def main():
         elif o in ("-s", "--speed"):
             options['speed'] = a
 
+        # choose how many write commands may be in flight
+        elif o in ("-w", "--window"):
+            options['window'] = int(a)
+        elif o == "--write-delay":
+            options['writedelay'] = int(a)
+
+        # only write what changed since the last download
+        elif o in ("-D", "--delta"):
+            options['delta'] = True
+        elif o == "--manifest-dir":
+            options['manifestdir'] = a
+        elif o == "--id-address":
+            options['idaddr'] = int(a, 0)
+
+        # do not use binary mode
+        elif o in ("-a", "--ascii"):
+            options['binary'] = False
+
+        # check every command and its reply
+        elif o in ("-F", "--framed"):
+            options['framed'] = True
+
+        # switch to the fastest rate the oscillator allows
+        elif o == "--osc":
+            options['osc'] = int(float(a))
+        elif o == "--max-error":
+            options['maxerror'] = float(a)
+        elif o == "--rates":
+            commands.append(("rates", o))
+
+        # give up on a silent monitor
+        elif o in ("-t", "--timeout"):
+            options['timeout'] = float(a)
+        elif o == "--connect-timeout":
+            options['connecttimeout'] = float(a)
+
+        # reset the PIC through the modem control lines
+        elif o in ("-r", "--reset"):
+            if not resetLines.has_key(a):
+                err("Invalid reset line %s\n" % a)
+                usage()
+            options['reset'] = a
+        elif o == "--reset-time":
+            options['resettime'] = int(a)
+
+        # only upload some ranges
+        elif o == "--ranges":
+            try:
+                options['ranges'] = parseRanges(a)
+            except ValueError:
+                err("Invalid address ranges %s\n" % a)
+                usage()
+        elif o == "--map":
+            options['map'] = a
+
+        # continue an interrupted download
+        elif o in ("-R", "--resume"):
+            options['resume'] = True
+        elif o == "--journal-dir":
+            options['journaldir'] = a
+
+        # sample file registers
+        elif o in ("-W", "--watch"):
+            commands.append(("watch", o))
+            options['watch'] = a
+        elif o == "--period":
+            options['period'] = float(a)
+        elif o == "--samples":
+            options['samples'] = int(a)
+
+        # report session statistics
+        elif o == "--stats":
+            options['stats'] = a
+
+        # read back the image after download
+        elif o in ("-V", "--verify"):
+            options['verify'] = True
+
+        # program several boards at once
+        elif o in ("-g", "--gang"):
+            commands.append(("gang", o))
+
         # Set size-limiting options
         elif o in ("-4", "--4k"):
             options['size'] = 4096
@@ -657,17 +2401,23 @@ def main():
 
         # choose download mode
         elif o in ("-d", "--download"):
-            if options['cmd'] == 'upload':
-                err("Upload and Download are mutually exclusive!\n")
-                usage()
-            options['cmd'] = "download"
+            commands.append(("download", o))
 
         # choose upload mode
         elif o in ("-u", "--upload"):
-            if options['cmd'] == 'download':
-                err("Upload and Download are mutually exclusive!\n")
+            commands.append(("upload", o))
+
+    # barf if conflicting commands were given, in whatever order
+    for i in range(len(commands)):
+        for j in range(i):
+            if (commands[j][0], commands[i][0]) in conflictingCommands or \
+               (commands[i][0], commands[j][0]) in conflictingCommands:
+                err("%s and %s are mutually exclusive!\n" % (commands[j][1],
+                                                             commands[i][1]))
                 usage()
-            options['cmd'] = "upload"
+    for cmd, o in commands:
+        if options['cmd'] != 'gang':
+            options['cmd'] = cmd
 
     # grab filename arg, if any
     if len(args) > 0:
@@ -677,26 +2427,60 @@ def main():
             usage(1)
         options['path'] = args[0]
 
+    # the map may come before the size options
+    if options['map']:
+        options['ranges'] = mapRanges(options['map'], options['size'])
+
     # barf if no command given
     if not options['cmd']:
         print "No command, defaulting to download"
         options['cmd'] = "download"
 
-    # do download, if asked to    
-    if options['cmd'] == 'download':
-        if not options['path']:
-            options['path'] = sys.stdin
-        do_download(**options)
+    # statistics are written even when the session failed
+    try:
+        # list line speeds, if asked to
+        if options['cmd'] == 'rates':
+            if not options['osc']:
+                err("--rates needs --osc\n")
+                usage()
+            for rate, x, error in baudrates(options['osc'],
+                                            options['maxerror']):
+                print "%6d bps: SPBRG=0x%02X (error %.2f%%)" % (rate, x, error)
+
+        # do download, if asked to    
+        elif options['cmd'] == 'download':
+            if not options['path']:
+                options['path'] = sys.stdin
+            do_download(**options)
 
-    # do upload, if asked to
-    elif options['cmd'] == 'upload':
-        if not options['path']:
-            options['path'] = sys.stdout
-        do_upload(**options)
+        # program several boards, if asked to
+        elif options['cmd'] == 'gang':
+            if not options['path']:
+                options['path'] = sys.stdin
+            do_gang(**options)
+
+        # do upload, if asked to
+        elif options['cmd'] == 'upload':
+            if not options['path']:
+                options['path'] = sys.stdout
+            do_upload(**options)
+
+        # sample file registers, if asked to
+        elif options['cmd'] == 'watch':
+            if not options['path']:
+                options['path'] = sys.stdout
+            do_watch(**options)
+    finally:
+        if options['stats'] and sessions:
+            writeStats(options['stats'])
 
 def log(s):
     if not quiet:
         err(s)
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except (Timeout, BadConnection, InvalidAddress, HexError, IOError), e:
+        err("\n%s: %s\n" % (progname, e))
+        sys.exit(1)
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+
+"""
+Throughput benchmark of pfd.py against the serial monitor emulator
+
+Downloads, verifies and uploads a few images through monsim.py with several
+monitor versions and transfer settings, and reports the words transferred per
+second, the number of commands (round trips when not pipelined) and the
+number of bytes sent in each direction. Every image downloaded is checked
+against the emulated device, and a scenario which fails is reported while
+the others still run. Each scenario ends with a new session at the initial
+line speed, which must reach the monitor even when the session before it
+raised the speed.
+"""
+
+import sys, os, time, getopt, StringIO, multiprocessing
+
+import pfd, monsim
+
+progname = sys.argv[0]
+
+# images used when none is given on the command line
+defaultImages = ["booster.hex", "generator.hex", "cquotebank.hex"]
+defaultImageDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "..", "..", "tests", "expected")
+
+# words of program memory read back by the upload benchmark
+defaultUploadSize = 1024
+
+# (name, monitor version, pfd options) of the configurations compared
+scenarios = [
+    ("v5 stop-and-wait", 5, {'window' : 1, 'binary' : False}),
+    ("v9 ascii", 9, {'window' : 4, 'binary' : False}),
+    ("v9 binary", 9, {'window' : 4, 'binary' : True}),
+    ("v10 binary", 10, {'window' : 4, 'binary' : True}),
+    ("v11 binary", 11, {'window' : 4, 'binary' : True}),
+    ("v14 pipelined", 14, {'window' : 4, 'binary' : True}),
+    ("v13 framed", 13, {'window' : 4, 'binary' : True, 'framed' : True}),
+    ("v14 upshifted", 14, {'window' : 1, 'binary' : True,
+                           'osc' : monsim.defaultOsc}),
+    ]
+
+# time (in seconds) given to the last session of a scenario to connect
+reconnectTimeout = 2.0
+
+def serve(conn, options):
+    """
+    Runs an emulated monitor in its own process, so that it does not share
+    the interpreter with pfd.py. Sends back the pseudo-terminal name, then
+    the statistics (and resets them) each time it is asked to.
+    """
+    monitor = monsim.Monitor(**options)
+    monitor.start()
+    conn.send(monitor.port)
+    while conn.recv():
+        conn.send(dict(monitor.stats))
+        monitor.resetStats()
+
+class Bench:
+    """
+    One emulated monitor and the pfd.py session talking to it
+    """
+    def __init__(self, version, monOptions, pfdOptions):
+        options = dict(monOptions)
+        options['version'] = version
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve,
+                                               args=(child, options))
+        self.process.daemon = True
+        self.process.start()
+
+        self.options = dict(pfd.defaultOptions)
+        self.options.update(pfdOptions)
+        self.options['port'] = self.conn.recv()
+        self.options['speed'] = monOptions['baudrate'] or pfd.defaultBaudrate
+        self.pic = pfd.PIC(**self.options)
+        self.pic.progress = lambda i: None
+        self.pic.connect()
+        if self.options['osc']:
+            self.pic.upshift()
+        self.stats()
+
+    def stats(self):
+        self.conn.send(True)
+        return self.conn.recv()
+
+    def measure(self, op, path):
+        """
+        Times a download of path, a verify of the last image downloaded,
+        an upload or a new session, returns (words, seconds, monitor
+        statistics). Raises an exception if the operation fails, or if the
+        image downloaded does not match the device contents.
+        """
+        start = time.time()
+        if op == "download":
+            self.plan = self.pic.download(path, **self.options)
+            words = len(self.plan)
+        elif op == "verify":
+            self.check()
+            words = len(self.plan)
+        elif op == "reconnect":
+            options = dict(self.options)
+            options['connecttimeout'] = reconnectTimeout
+            pfd.PIC(**options).connect()
+            words = 0
+        else:
+            self.pic.upload(StringIO.StringIO(), **self.options)
+            words = self.pic.total
+        result = words, time.time() - start, self.stats()
+    
+        # downloads are checked once timed, leaving the statistics alone
+        if op == "download":
+            self.check()
+            self.stats()
+        return result
+    
+    def check(self):
+        """
+        Verifies the last image downloaded
+        """
+        bad = self.pic.verify(self.plan)
+        if bad:
+            raise Exception("verify failed, %d words differ, first one at "
+                            "0x%x" % (len(bad), bad[0]))
+
+    def close(self):
+        self.conn.send(False)
+        self.process.join()
+
+def usage(ret=1):
+
+    err("Usage: %s [options] [file.hex ...]\n" % progname)
+    err("Benchmarks pfd.py against the serial monitor emulator\n")
+    err("Options:\n")
+    err("   -s, --speed=nnnn\n")
+    err("       Emulated line speed, 0 for no pacing (default %d)\n" %
+        monsim.defaultBaudrate)
+    err("   --latency=ms\n")
+    err("       Emulated adapter latency (default %d)\n" % monsim.defaultLatency)
+    err("   --write-time=ms\n")
+    err("       Emulated write time (default %d)\n" % monsim.defaultWriteTime)
+    err("   --size=nnnn\n")
+    err("       Program memory words read by uploads (default %d)\n" %
+        defaultUploadSize)
+    err("Images default to %s from tests/expected\n" % ", ".join(defaultImages))
+
+    sys.exit(ret)
+
+def err(s):
+    sys.stderr.write(s)
+    sys.stderr.flush()
+
+def main():
+
+    monOptions = {'baudrate' : monsim.defaultBaudrate,
+                  'latency' : monsim.defaultLatency,
+                  'writeTime' : monsim.defaultWriteTime}
+    pfdOptions = {'size' : defaultUploadSize}
+
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "?hs:",
+            ["help", "speed=", "latency=", "write-time=", "size="])
+    except getopt.GetoptError:
+        usage()
+
+    for o, a in opts:
+        if o in ("-h", "-?", "--help"):
+            usage(0)
+        elif o in ("-s", "--speed"):
+            monOptions['baudrate'] = int(a)
+        elif o == "--latency":
+            monOptions['latency'] = float(a)
+        elif o == "--write-time":
+            monOptions['writeTime'] = float(a)
+        elif o == "--size":
+            pfdOptions['size'] = int(a)
+
+    images = args or [os.path.join(defaultImageDir, i) for i in defaultImages]
+    pfd.quiet = True
+
+    print "%-18s %-24s %6s %8s %8s %8s %8s %8s" % (
+        "scenario", "operation", "words", "seconds", "words/s",
+        "commands", "sent", "received")
+    failed = []
+    for name, version, options in scenarios:
+        options = dict(options)
+        options.update(pfdOptions)
+        runs = [("download", i) for i in images] + \
+               [("verify", None), ("upload", None), ("reconnect", None)]
+        bench = None
+        try:
+            op = "connect"
+            bench = Bench(version, monOptions, options)
+            for op, path in runs:
+                if path:
+                    op += " " + os.path.basename(path)
+                words, seconds, stats = bench.measure(op.split()[0], path)
+                print "%-18s %-24s %6d %8.2f %8.0f %8d %8d %8d" % (
+                    name, op, words, seconds, words / seconds,
+                    stats['commands'], stats['rx'], stats['tx'])
+                if stats['overruns'] or stats['errors'] or stats['garbled']:
+                    print "%-18s %d bytes lost, %d corrupted, %d garbled" % (
+                        "", stats['overruns'], stats['errors'],
+                        stats['garbled'])
+                sys.stdout.flush()
+        except Exception, e:
+            # the session may be out of step with the monitor, give up on
+            # the rest of the scenario
+            print "%-18s %-24s FAILED: %s" % (name, op,
+                                             str(e) or e.__class__.__name__)
+            sys.stdout.flush()
+            failed.append(name)
+        if bench:
+            bench.close()
+
+    print
+    if failed:
+        print "%d of %d scenarios failed: %s" % (len(failed), len(scenarios),
+                                                 ", ".join(failed))
+        sys.exit(1)
+    print "All %d scenarios passed verification" % len(scenarios)
+
+if __name__ == '__main__':
+    main()
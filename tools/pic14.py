@@ -0,0 +1,139 @@
+"""
+pic14
+
+Instruction set of the mid-range (14 bits) PIC processors, as targeted by
+picforth. Opcodes are decoded the same way as the disassembler of
+picforth.fs does, once and for all: 'table' holds the decoding of each of
+the 16384 possible opcodes.
+
+Released into the public domain
+"""
+
+import os, sys, re
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "bootloading"))
+import hexfile
+del sys.path[0]
+
+# operand kinds
+NONE = 0        # no operand
+FILE = 1        # file register
+FILE_D = 2      # file register and destination (0 for w, 1 for f)
+BIT = 3         # file register and bit number
+LITERAL = 4     # 8 bits literal
+ADDRESS = 5     # 11 bits program address
+DATA = 6        # not an instruction, the opcode itself
+
+def decode(op):
+    """
+    Decodes a 14 bits opcode into a (mnemonic, kind, a, b) tuple: a is the
+    file register, literal or address, b the destination or bit number
+    """
+    f = op & 0x7f
+    d = op >> 7 & 1
+
+    # control operations
+    if op & 0x3000 == 0x2000:
+        return (op & 0x800 and "goto" or "call", ADDRESS, op & 0x7ff, 0)
+
+    # literal operations
+    if op & 0x3000 == 0x3000:
+        k = op & 0xff
+        if op & 0xe00 == 0xe00: return ("addlw", LITERAL, k, 0)
+        if op & 0xf00 == 0x900: return ("andlw", LITERAL, k, 0)
+        if op & 0xf00 == 0x800: return ("iorlw", LITERAL, k, 0)
+        if op & 0xc00 == 0x000: return ("movlw", LITERAL, k, 0)
+        if op & 0xc00 == 0x400: return ("retlw", LITERAL, k, 0)
+        if op & 0xe00 == 0xc00: return ("sublw", LITERAL, k, 0)
+        if op & 0xf00 == 0xa00: return ("xorlw", LITERAL, k, 0)
+        return (".dw", DATA, op, 0)
+
+    # bit-oriented file register operations
+    if op & 0x3000 == 0x1000:
+        return (["bcf", "bsf", "btfsc", "btfss"][op >> 10 & 3], BIT,
+                f, op >> 7 & 7)
+
+    # byte-oriented file register operations
+    group = op >> 8 & 0xf
+    if group == 0:
+        if op & 0x80: return ("movwf", FILE, f, 0)
+        if op & 0x1f == 0: return ("nop", NONE, 0, 0)
+        if op == 0x64: return ("clrwdt", NONE, 0, 0)
+        if op == 0x09: return ("retfie", NONE, 0, 0)
+        if op == 0x08: return ("return", NONE, 0, 0)
+        if op == 0x63: return ("sleep", NONE, 0, 0)
+        return (".dw", DATA, op, 0)
+    if group == 1:
+        if op & 0x80: return ("clrf", FILE, f, 0)
+        return ("clrw", NONE, 0, 0)
+    return (fileops[group], FILE_D, f, d)
+
+fileops = [None, None, "subwf", "decf", "iorwf", "andwf", "xorwf", "addwf",
+           "movf", "comf", "incf", "decfsz", "rrf", "rlf", "swapf", "incfsz"]
+
+table = [decode(op) for op in range(0x4000)]
+
+reSpaces = re.compile("\\s+")
+
+# registers and bits shared by every bank
+PCL = 0x02
+STATUS = 0x03
+RP0 = 5
+RP1 = 6
+
+# instructions skipping the next one, and returning from a call
+skips = ("btfsc", "btfss", "decfsz", "incfsz")
+returns = ("return", "retlw", "retfie")
+
+def writesPCL(op):
+    """
+    Tells whether an opcode modifies PCL, that is jumps to a computed
+    address
+    """
+    mnemonic, kind, a, b = table[op & 0x3fff]
+    if a != PCL:
+        return False
+    return kind == FILE or kind == FILE_D and b == 1 or \
+           mnemonic in ("bcf", "bsf")
+
+def isBankSwitch(op):
+    """
+    Tells whether an opcode selects a bank for direct addressing
+    """
+    mnemonic, kind, a, b = table[op & 0x3fff]
+    return mnemonic in ("bcf", "bsf") and a == STATUS and b in (RP0, RP1)
+
+def operands(op):
+    """
+    Returns the operands of an opcode as a list of strings
+    """
+    mnemonic, kind, a, b = table[op & 0x3fff]
+    if kind == NONE:
+        return []
+    if kind == FILE_D:
+        return ["0x%x" % a, "wf"[b]]
+    if kind == BIT:
+        return ["0x%x" % a, "%d" % b]
+    if kind == DATA:
+        return ["0x%04x" % a]
+    return ["0x%x" % a]
+
+def readHex(path):
+    """
+    Reads an Intel hex file, returns the hexfile.Hexfile object
+    """
+    return hexfile.Hexfile(path=path)
+
+def readMap(path):
+    """
+    Builds a dictionary numerical addr->sym from a .map file, leaving
+    out the names of RAM areas
+    """
+    addr2sym = {}
+    for line in file(path):
+        flds = reSpaces.split(line.strip())
+        if len(flds) < 3 or flds[1] == "ram":
+            continue
+        addr2sym[int(flds[0], 16)] = flds[2]
+    return addr2sym